@@ -1,6 +1,8 @@
 import openpyxl
 import os, sys
 import json
+sys.path.insert(0, '..')
+from obj_correct import catalog
 
 source_fn = '../data/VIS-EXT-Coated-Plano-Convex-PCX-Lenses.xlsx'
 output_fn = '../obj_correct/data/edmund_plano_convex.json'
@@ -45,3 +47,6 @@ lens_data = {
 
 with open(output_fn, 'w') as f:
     json.dump(lens_data, f)
+
+# Packed binary version, which can be memory mapped
+catalog.save(lens_data, catalog.table_fn(output_fn), key='stock')
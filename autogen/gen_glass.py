@@ -1,6 +1,8 @@
 import openpyxl
 import os, sys
 import json
+sys.path.insert(0, '..')
+from obj_correct import catalog
 
 source_fn = '../data/LaCroix Dynamic Material Selection Data Tool vJanuary 2015.xlsm'
 output_fn = '../obj_correct/data/glass.json'
@@ -49,3 +51,6 @@ glass_data['7980'] = glass_data['Fused Silica (Corning 7980)']
 
 with open(output_fn, 'w') as f:
     json.dump(glass_data, f)
+
+# Packed binary version, which can be memory mapped
+catalog.save(glass_data, catalog.table_fn(output_fn), key='name')
@@ -0,0 +1,10 @@
+import sys
+sys.path.insert(0, '..')
+from obj_correct import catalog
+
+# Generates the packed binary (.npy) catalogs from the JSON data files.  This
+#  is also done by gen_glass.py and gen_edmund.py, but can be run on its own
+#  if the JSON files are changed.
+
+catalog.convert('../obj_correct/data/glass.json', key='name')
+catalog.convert('../obj_correct/data/edmund_plano_convex.json', key='stock')
@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+#
+# Copyright 2022 Dustin Kleckner
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Measures the time to import the package (and do the first lookups) in a
+#  fresh interpreter, as seen by e.g. a new worker process.  Each statement
+#  is run in its own process, after importing numpy (which is not counted).
+#
+# Usage: python benchmarks/import_time.py [repeats]
+
+import subprocess
+import sys
+import os
+
+ROOT = os.path.abspath(os.path.join(os.path.split(__file__)[0], '..'))
+
+CASES = [
+    ('import obj_correct', 'import obj_correct'),
+    ('from obj_correct import *', 'from obj_correct import *'),
+    ('first glass lookup', 'from obj_correct import *; index.eval("N-BK7", 0.5)'),
+    ('first trace (21 rays)', '''from obj_correct import *
+N = np.zeros((21, 3)); N[:, 0] = np.linspace(-0.4, 0.4, 21); N[:, 2] = 1
+stack.Element("N-BK7", 2).offset(1).trace_rays(np.zeros(3), N, 15)'''),
+    ('(reference) import matplotlib.pyplot', 'import matplotlib.pyplot'),
+]
+
+TEMPLATE = '''
+import numpy as np, time
+t0 = time.perf_counter()
+{}
+print(time.perf_counter() - t0)
+'''
+
+
+def time_statement(stmt, repeats):
+    times = []
+    for i in range(repeats):
+        out = subprocess.run([sys.executable, '-c', TEMPLATE.format(stmt)],
+            cwd=ROOT, capture_output=True, text=True, check=True)
+        times.append(float(out.stdout.split()[-1]))
+    times.sort()
+    return times[len(times)//2]
+
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 7
+
+    for name, stmt in CASES:
+        print(f'{name:>40s}: {time_statement(stmt, repeats)*1E3:8.1f} ms (median of {repeats})')
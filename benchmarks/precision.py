@@ -0,0 +1,78 @@
+#!/usr/bin/python3
+#
+# Copyright 2022 Dustin Kleckner
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares tracing in single and double precision: the time for each of the
+#  tracing modes, and the difference between the results.  The test system is
+#  a cover slip and a stock lens, with a wide field bundle of rays.
+#
+# Usage: python benchmarks/precision.py [rays]
+
+import os
+import sys
+import time
+import numpy as np
+
+# Use the package from this checkout, as in autogen (it need not be installed)
+sys.path.insert(0, os.path.join(os.path.split(os.path.abspath(__file__))[0], '..'))
+from obj_correct import stack, stock
+from obj_correct.vector import Workspace
+from obj_correct import jit
+
+
+def best_time(func, repeats=5):
+    times = []
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+if __name__ == '__main__':
+    rays = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    z_final = 30
+
+    optics = stack.OpticalStack([
+        stack.Element('N-BK7', 0.17).offset(1),
+        stock.edmund_plano_convex['88-675'].flip().offset(3.7)
+    ])
+
+    # Random rays from a 1 mm field, up to NA ~ 0.3
+    rng = np.random.default_rng(0)
+    X = np.zeros((rays, 3))
+    X[:, :2] = rng.uniform(-0.5, 0.5, (rays, 2))
+    N = np.ones((rays, 3))
+    N[:, :2] = rng.uniform(-0.3, 0.3, (rays, 2))
+
+    modes = [('numpy', {}), ('workspace', {'workspace': Workspace()})]
+    if jit.HAS_NUMBA:
+        modes.append(('jit', {'jit': True}))
+
+    print(f'{rays} rays, {len(optics.stack)} surfaces')
+    for name, kw in modes:
+        t = {}
+        for dtype in ('d', 'f'):
+            optics.trace_rays(X, N, z_final, dtype=dtype, **kw)
+            t[dtype] = best_time(lambda: optics.trace_rays(X, N, z_final, dtype=dtype, **kw))
+        print(f'{name:>12s}: float64 {t["d"]*1E3:8.1f} ms, float32 {t["f"]*1E3:8.1f} ms ({t["d"]/t["f"]:.2f}x)')
+
+    ref = optics.trace_rays(X, N, z_final)
+    r32 = optics.trace_rays(X, N, z_final, dtype='f')
+    good = np.isfinite(ref).all(-1) & np.isfinite(r32).all(-1)
+    err = np.abs(r32 - ref).max(-1)[good]
+    scale = np.maximum(np.abs(ref).max(-1)[good], 1)
+    print(f'     float32: max error {err.max():.2e} mm, relative {(err/scale).max():.2e}')
+    print(f'              same rays lost: {(np.isnan(ref) == np.isnan(r32)).all()}')
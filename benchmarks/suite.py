@@ -0,0 +1,256 @@
+#!/usr/bin/python3
+#
+# Copyright 2022 Dustin Kleckner
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmarks of the hot paths: tracing (single surfaces and stacks, over
+#  bundle sizes, stack depths and wavelengths), paraxial matrices, index
+#  evaluation, catalog search and an end to end stock lens sweep (as in
+#  examples/stock_correct.py).
+#
+# Each case is timed as the best of several runs, and compared to the stored
+#  baseline (benchmarks/baseline.json); cases which are slower than the
+#  baseline by more than the tolerance are flagged, and the exit status is
+#  nonzero.  Baselines are machine dependent, so they should be regenerated
+#  (with --save) when moving to a different machine.
+#
+# Usage: python benchmarks/suite.py [-k NAME] [--save] [--tolerance 1.3]
+
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+import numpy as np
+
+# Use the package from this checkout, as in autogen (it need not be installed)
+sys.path.insert(0, os.path.join(os.path.split(os.path.abspath(__file__))[0], '..'))
+from obj_correct import stack, stock, surface, index, jit
+
+BASELINE = os.path.join(os.path.split(__file__)[0], 'baseline.json')
+
+
+def fan(rays, NA=0.4):
+    '''Rays from the origin, uniformly filling a square of directions.'''
+    rng = np.random.default_rng(0)
+    N = np.ones((rays, 3))
+    N[:, :2] = rng.uniform(-NA, NA, (rays, 2))
+    return np.zeros(3), N
+
+
+def cover_and_lens():
+    return stack.OpticalStack([
+        stack.Element('N-BK7', 2).offset(1),
+        stock.edmund_plano_convex['88-675'].flip().offset(3.7)
+    ])
+
+
+def deep_stack(elements):
+    return stack.OpticalStack([stack.Element('N-BK7', 0.5, R1=20, R2=-20).offset(1 + i)
+        for i in range(elements)])
+
+
+# Each case is (name, setup, rays): setup() returns the function to time, and
+#  rays (if not None) is used to report the throughput.
+CASES = []
+
+
+def case(name, rays=None):
+    def register(setup):
+        CASES.append((name, setup, rays))
+        return setup
+    return register
+
+
+for rays in (10, 1000, 100000, 1000000):
+    @case(f'surface.trace_rays[{rays}]', rays)
+    def setup(rays=rays):
+        s = surface.Surface('N-BK7', 1, r_clip=5, R=10)
+        X, N = fan(rays)
+        N /= np.sqrt((N**2).sum(-1))[:, np.newaxis]
+        return lambda: s.trace_rays(X, N)
+
+    @case(f'stack.trace_rays[{rays}]', rays)
+    def setup(rays=rays):
+        optics = cover_and_lens()
+        X, N = fan(rays)
+        return lambda: optics.trace_rays(X, N, 15)
+
+for elements in (1, 4, 16):
+    @case(f'stack.trace_rays[depth={2*elements}]', 10000)
+    def setup(elements=elements):
+        optics = deep_stack(elements)
+        X, N = fan(10000, 0.2)
+        return lambda: optics.trace_rays(X, N, 2 + elements)
+
+for nλ in (1, 8, 32):
+    @case(f'stack.trace_rays[λ={nλ}]', 10000 * nλ)
+    def setup(nλ=nλ):
+        optics = cover_and_lens()
+        λ = np.linspace(0.4, 0.7, nλ)
+        X, N = fan(10000)
+        return lambda: optics.trace_rays(X, N, 15, λ)
+
+@case('stack.trace_rays[meridional, 100000]', 100000)
+def setup():
+    optics = cover_and_lens()
+    X, N = fan(100000)
+    N[:, 1] = 0
+    return lambda: optics.trace_rays(X, N, 15)
+
+@case('stack.trace_rays[opl, 100000]', 100000)
+def setup():
+    optics = cover_and_lens()
+    X, N = fan(100000)
+    opl = np.zeros(100000)
+    return lambda: optics.trace_rays(X, N, 15, opl=opl)
+
+if jit.HAS_NUMBA:
+    @case('stack.trace_rays[jit, 100000]', 100000)
+    def setup():
+        optics = cover_and_lens()
+        X, N = fan(100000)
+        optics.trace_rays(X[:1], N[:1], 15, jit=True)
+        return lambda: optics.trace_rays(X, N, 15, jit=True)
+
+
+@case('stack.M')
+def setup():
+    optics = cover_and_lens()
+    return lambda: optics.M()
+
+
+@case('stack.M[100 λ x 100 offsets]')
+def setup():
+    optics = cover_and_lens()
+    λ = np.linspace(0.4, 0.7, 100)
+    offset = np.linspace(-1, 1, 100)
+    return lambda: optics.M(λ, offset=offset)
+
+
+@case('index.eval[cached]')
+def setup():
+    return lambda: index.eval('N-BK7', 0.5)
+
+
+@case('index.eval[uncached, 1000 λ]')
+def setup():
+    λ = np.linspace(0.4, 0.7, 1000)
+    def run():
+        index.CACHE.clear()
+        index.eval('N-BK7', λ)
+    return run
+
+
+@case('LensLibrary.search[diameter]')
+def setup():
+    return lambda: stock.edmund_plano_convex.search(diameter=12)
+
+
+@case('LensLibrary.search[f range]')
+def setup():
+    return lambda: stock.edmund_plano_convex.search(f=(10., 50.), diameter=12)
+
+
+def _sweep_metric(optics):
+    # The metric of examples/stock_correct.py
+    X, N = np.zeros(3), np.zeros((21, 3))
+    N[:, 0] = np.linspace(-0.4, 0.4, 21)
+    N[:, 2] = 1
+    return (stock.offset_error(optics, X, N, 0.5)**2).mean(-1) * 1000
+
+
+for executor in ('batch', None):
+    @case(f'stock.sweep[{executor}]')
+    def setup(executor=executor):
+        cover = stack.Element('N-BK7', 2).offset(1)
+        z_range = (cover.get_end()[2] + 0.5, 10)
+        return lambda: stock.sweep(cover, stock.edmund_plano_convex, _sweep_metric,
+            z_range, query=dict(diameter=12), executor=executor)
+
+
+def best_time(func, min_time=0.2, repeats=5):
+    '''Best time per call, over several repeats of enough calls to take at
+    least min_time.'''
+    func()
+    number = 1
+    while True:
+        t0 = time.perf_counter()
+        for i in range(number):
+            func()
+        t = time.perf_counter() - t0
+        if t >= min_time or number >= 1000000:
+            break
+        number *= 10
+
+    times = [t]
+    for i in range(repeats - 1):
+        t0 = time.perf_counter()
+        for i in range(number):
+            func()
+        times.append(time.perf_counter() - t0)
+
+    return min(times) / number
+
+
+def machine():
+    return dict(python=platform.python_version(), numpy=np.__version__,
+        machine=platform.machine(), processor=platform.processor(),
+        cpus=os.cpu_count(), numba=jit.HAS_NUMBA)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the obj_correct benchmarks.')
+    parser.add_argument('-k', dest='select', default='', help='only run cases whose name contains this')
+    parser.add_argument('--save', action='store_true', help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=1.3, help='allowed slowdown relative to the baseline')
+    args = parser.parse_args()
+
+    baseline = {}
+    if os.path.exists(BASELINE):
+        with open(BASELINE, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('machine') != machine():
+            print('Warning: the baseline was recorded on a different machine:', baseline.get('machine'))
+
+    results = {}
+    slow = []
+    for name, setup, rays in CASES:
+        if args.select not in name:
+            continue
+
+        t = best_time(setup())
+        results[name] = t
+
+        line = f'{name:>36s}: {t*1E3:10.4f} ms'
+        if rays is not None:
+            line += f' {rays/t/1E6:8.2f} Mrays/s'
+        t0 = baseline.get('times', {}).get(name)
+        if t0 is not None:
+            line += f'   {t/t0:5.2f}x baseline'
+            if t > args.tolerance * t0:
+                line += '  SLOWER'
+                slow.append(name)
+        print(line)
+
+    if args.save:
+        times = baseline.get('times', {})
+        times.update(results)
+        with open(BASELINE, 'w') as f:
+            json.dump(dict(machine=machine(), times=times), f, indent=2)
+        print(f'Saved baseline to {BASELINE}')
+    elif slow:
+        print(f'{len(slow)} case(s) slower than the baseline')
+        sys.exit(1)
@@ -17,8 +17,6 @@
 from obj_correct import *
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy import optimize
-import time
 
 # wavelength + NA for rays
 λ = 0.5
@@ -49,78 +47,49 @@ N2[:, 2] = 1
 
 
 def compute_offset_error(optical_stack, X=X, N=N, λ=opt_λ):
-    M, z = optical_stack.M()
-    trace = optical_stack.trace_rays(X, N, 15, λ)
-
-    # Get the slope of the final ray
-    Nf = trace[:, -1] - trace[:, -2]
-    Nf /= Nf[:, 2:3]
-
-    # Project it back to the focus plane for paraxial rays
-    Xt = trace[:, -1] + (z - trace[:, -1, 2:3]) * Nf
-
-    return Xt[:, 0]
+    # Offset of the rays when projected back to the paraxial focus; works for
+    #  single stacks and batches of stacks.
+    return stock.offset_error(optical_stack, X, N, λ)
 
 
 lens_stock = stock.edmund_plano_convex
 
-lenses = lens_stock.search(diameter=12)
-
-stock_id = next(iter(lenses))
-info = lenses[stock_id]
-
-
-def err_func(offset, lens):
-    if isinstance(offset, np.ndarray):
-        offset = offset[0]
-    err = compute_offset_error(stack.OpticalStack([cover, lens.offset(offset)]))
-    return (err**2).mean() * 1000
-
-# for z in np.linspace(min_z, max_z - info['t'], 11):
-#     start = time.time()
-#     optics = stack.OpticalStack([cover, lens.offset(z)])
-#     err = compute_offset_error(optics)
-#     el = time.time() - start
-#     print(f'z = {z:.2f}, RMS error: {np.std(err)*1000}')
-#     plt.plot(m, err * 1000, label=f'{z:.2f}')
-
-results = {}
-
-for flipped in (False, True):
-    for stock_id, info in lens_stock.search(diameter=12).items():
-        lens = lens_stock[stock_id]
-        if flipped:
-            lens = lens.flip()
 
-        mz = max_z - info['t']
+def err_func(optics):
+    err = compute_offset_error(optics)
+    return (err**2).mean(-1) * 1000
 
-        res = optimize.minimize(err_func, (0.5*(min_z + mz),), args=(lens,), bounds=((min_z, mz),))
-        z = res['x'][0]
 
-        results[(stock_id, flipped)] = (z, res['fun'], lens)
+def print_progress(done, total):
+    print(f'\r{done}/{total} candidates', end='', flush=True)
 
-        print(f"{stock_id} (dia={info['diameter']}, f={info['f']}{' flipped' if flipped else ''}, {info['glass']}) RMS error: {res['fun']} @ z={z:.2f}")
 
+# All of the candidates are fit at once (executor='batch'); to fit them one
+#  at a time on a process pool use executor='process' instead.  (The guard is
+#  needed in that case on platforms which spawn worker processes.)
+if __name__ == '__main__':
+    results = stock.sweep(cover, lens_stock, err_func, (min_z, max_z),
+        query=dict(diameter=12), executor='batch', progress=print_progress)
+    print()
 
-best = list(results.keys())
-best.sort(key=lambda k: results[k][1])
-# print(best[:10])
+    for r in results:
+        info = lens_stock.data[r['stock_id']]
+        print(f"{r['stock_id']} (dia={info['diameter']}, f={info['f']}{' flipped' if r['flipped'] else ''}, {info['glass']}) RMS error: {r['error']} @ z={r['z']:.2f}")
 
-best_err = results[best[0]][1]
+    best_err = results[0]['error']
 
-for id in best:
-    z, err, lens = results[id]
-    if err > best_err * 5:
-        break
-    stock_id, flipped = id
-    info = lens_stock.data[stock_id]
-    optics = stack.OpticalStack([cover, lens.offset(z)])
-    err = compute_offset_error(optics, N=N2)
-    plt.plot(m2, err * 1000, label=f"{stock_id} (dia={info['diameter']}, f={info['f']}{' flipped' if flipped else ''}, {info['glass']}) @ z={z:.2f}")
+    for r in results:
+        if r['error'] > best_err * 5:
+            break
+        stock_id, flipped, z = r['stock_id'], r['flipped'], r['z']
+        info = lens_stock.data[stock_id]
+        optics = stack.OpticalStack([cover, r['lens'].offset(z)])
+        err = compute_offset_error(optics, N=N2)
+        plt.plot(m2, err * 1000, label=f"{stock_id} (dia={info['diameter']}, f={info['f']}{' flipped' if flipped else ''}, {info['glass']}) @ z={z:.2f}")
 
-plt.legend()
-plt.ylim(-1, 1)
-plt.show()
+    plt.legend()
+    plt.ylim(-1, 1)
+    plt.show()
 
 
 
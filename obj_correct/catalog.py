@@ -0,0 +1,84 @@
+#!/usr/bin/python3
+#
+# Copyright 2022 Dustin Kleckner
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Packed binary (columnar) versions of the JSON data files.  The catalogs are
+#  stored as NumPy structured arrays in .npy files, which can be memory mapped
+#  so that many worker processes share a single copy without parsing it.
+
+import numpy as np
+import os
+import json
+
+
+def columns(data, key='name'):
+    '''Convert a dictionary of records (as stored in the JSON data files) to a
+    structured array, with the dictionary keys stored in the field `key`.
+
+    String fields are stored as fixed width unicode, numbers as doubles, and
+    lists as fixed length double arrays (padded with zeros).'''
+    names = list(data.keys())
+    fields = list(data[names[0]].keys())
+
+    dtype = [(key, f'U{max(len(k) for k in names)}')]
+    for field in fields:
+        vals = [data[k][field] for k in names]
+        if isinstance(vals[0], str):
+            dtype.append((field, f'U{max(len(v) for v in vals)}'))
+        elif isinstance(vals[0], (list, tuple)):
+            dtype.append((field, 'f8', (max(len(v) for v in vals),)))
+        else:
+            dtype.append((field, 'f8'))
+
+    table = np.zeros(len(names), dtype=dtype)
+    table[key] = names
+    for field in fields:
+        if table.dtype[field].shape:
+            for i, k in enumerate(names):
+                v = data[k][field]
+                table[field][i, :len(v)] = v
+        else:
+            table[field] = [data[k][field] for k in names]
+
+    return table
+
+
+def records(table, key='name'):
+    '''Convert a structured array back to a dictionary of records (the inverse
+    of `columns`, except that padding is kept).'''
+    fields = [f for f in table.dtype.names if f != key]
+    return {str(row[key]): {f: row[f].tolist() for f in fields} for row in table}
+
+
+def save(data, fn, key='name'):
+    '''Save a dictionary of records as a structured array in a .npy file.'''
+    np.save(fn, columns(data, key))
+
+
+def load(fn, mmap=True):
+    '''Load a catalog saved with `save`; by default it is memory mapped.'''
+    return np.load(fn, mmap_mode='r' if mmap else None)
+
+
+def table_fn(json_fn):
+    '''Filename of the packed version of a JSON data file.'''
+    return os.path.splitext(json_fn)[0] + '.npy'
+
+
+def convert(json_fn, key='name'):
+    '''Create (or update) the packed version of a JSON data file.'''
+    with open(json_fn, 'r') as f:
+        data = json.load(f)
+    save(data, table_fn(json_fn), key)
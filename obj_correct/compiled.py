@@ -0,0 +1,786 @@
+#!/usr/bin/python3
+#
+# Copyright 2022 Dustin Kleckner
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import threading
+import time
+from . import DEFAULT_λ
+from . import index
+from . import instrument
+from .surface import (Surface, PerfectLens, _refract, _perfect_lens, _refract_jac,
+    _perfect_lens_jac, _refract_inplace, _perfect_lens_inplace, _clip_inplace, _perfect_lens_path)
+from .vector import norm, dot, Workspace
+
+# Layer types
+PLANE = 0
+SPHERE = 1
+PERFECT = 2
+KIND_NAMES = ('plane', 'sphere', 'perfect')
+
+
+class CompiledStack:
+    '''Immutable, flattened form of an OpticalStack at fixed wavelength(s).
+
+    The layers are stored as a struct-of-arrays, with the refractive indices
+    evaluated once for every wavelength.  Normally this is not created
+    directly, but obtained from OpticalStack.compile, which caches it.
+
+    Attributes
+    ----------
+    λ : float or array
+        The wavelength(s) the stack was compiled for.
+    kind : (S,) int array
+        Layer type (PLANE, SPHERE or PERFECT).
+    center : (S, 3) array
+        Layer (vertex) positions; z = center[:, 2].
+    R : (S,) array
+        Radius of curvature (0 for planes and perfect lenses).
+    C : (S, 3) array
+        Center of curvature (= center for planes and perfect lenses).
+    sgn : (S,) array
+        Sign of R.
+    r_clip : (S,) array
+        Clip radius (inf if not clipped).
+    f : (S,) array
+        Focal length of perfect lenses (inf otherwise).
+    optical_center : (S, 3) array
+        Optical center of perfect lenses (= center otherwise).
+    vergence : (S,) array
+        Inverse object distance of perfect lenses, for the optical path
+        (0 for an object at infinity, and for other layers).
+    meridional : bool
+        True if all the layers are centered in the x-z plane, so that rays
+        in this plane stay in it.
+    n : (S+1,) + λ.shape array
+        Index before the first layer, and after every layer.
+    m : (S,) + λ.shape array
+        Ratio of the indices before/after each layer.
+    layer_M : (S,) + λ.shape + (2, 2) array
+        Paraxial (ABCD) matrix of each layer.
+    '''
+
+    def __init__(self, optical_stack, λ=DEFAULT_λ):
+        layers = optical_stack.stack
+        S = len(layers)
+
+        self.λ = λ
+        self.kind = np.zeros(S, dtype='i8')
+        self.center = np.zeros((S, 3))
+        self.R = np.zeros(S)
+        self.r_clip = np.full(S, np.inf)
+        self.f = np.full(S, np.inf)
+        self.vergence = np.zeros(S)
+        self.optical_center = np.zeros((S, 3))
+
+        shape = np.shape(λ)
+        n = [np.broadcast_to(index.eval(optical_stack.n0, λ), shape)]
+
+        for i, layer in enumerate(layers):
+            self.center[i] = layer.center
+            self.optical_center[i] = layer.center
+            if layer.r_clip is not None:
+                self.r_clip[i] = layer.r_clip
+
+            if isinstance(layer, PerfectLens):
+                self.kind[i] = PERFECT
+                self.f[i] = layer.f
+                self.vergence[i] = layer._vergence()
+                self.optical_center[i] = layer.optical_center
+                n.append(n[-1])
+            elif isinstance(layer, Surface):
+                if layer.R is None:
+                    self.kind[i] = PLANE
+                else:
+                    self.kind[i] = SPHERE
+                    self.R[i] = layer.R
+                n.append(np.broadcast_to(index.eval(layer.n, λ), shape))
+            else:
+                raise ValueError(f'Invalid object in stack ({repr(layer)})')
+
+        self._finish(n)
+
+    @classmethod
+    def combine(cls, parts, n0=1, λ=DEFAULT_λ):
+        '''Combine compiled stacks (all at wavelength(s) λ) into one, reusing
+        their layers and evaluated indices.
+
+        parts is a list of (compiled, transforms), where transforms is a
+        sequence of (sign, shift) applied in turn to the layers: sign = 1
+        offsets them by shift (as Surface.offset), and sign = -1 flips them
+        about shift (as Surface.flip).  The layers are sorted by z, and the
+        result is identical to compiling the combined OpticalStack.'''
+        center, optical_center, R = [], [], []
+        for compiled, transforms in parts:
+            c, oc, r = compiled.center, compiled.optical_center, compiled.R
+            for sign, shift in transforms:
+                if sign > 0:
+                    c, oc = c + shift, oc + shift
+                else:
+                    c, oc, r = shift - c, shift - oc, -r
+            center.append(c)
+            optical_center.append(oc)
+            R.append(r)
+
+        center = np.concatenate(center)
+        optical_center = np.concatenate(optical_center)
+
+        # If the parts are only offset, and stay in order, the result is the
+        #  same as the last combination of these parts, apart from the layer
+        #  positions.
+        flipped = any(sign < 0 for c, t in parts for sign, shift in t)
+        z = center[:, 2]
+        reuse = not flipped and not (z[1:] < z[:-1]).any()
+        if reuse:
+            key = (n0,) + tuple(id(c) for c, t in parts)
+            with cls._combined_lock:
+                template = cls._combined.get(key)
+            if template is not None and all(c is c0 for (c, t), c0 in zip(parts, template[0])):
+                return template[1]._moved(center, optical_center)
+
+        self = cls.__new__(cls)
+        self.λ = λ
+        order = slice(None) if reuse else np.argsort(z, kind='stable')
+        self.center = center[order]
+        self.optical_center = optical_center[order]
+        self.kind = np.concatenate([c.kind for c, t in parts])[order]
+        self.R = np.concatenate(R)[order]
+        if flipped:
+            self.R[self.kind != SPHERE] = 0
+        self.r_clip = np.concatenate([c.r_clip for c, t in parts])[order]
+        self.f = np.concatenate([c.f for c, t in parts])[order]
+        self.vergence = np.concatenate([c.vergence for c, t in parts])[order]
+
+        # Index after each layer; perfect lenses keep the index before them
+        n = np.concatenate([[np.broadcast_to(index.eval(n0, λ), np.shape(λ))]]
+            + [c.n[1:] for c, t in parts])
+        if not reuse:
+            n[1:] = n[1:][order]
+        for i in np.where(self.kind == PERFECT)[0]:
+            n[i+1] = n[i]
+
+        if reuse:
+            self._finish(n, np.concatenate([c.layer_M for c, t in parts]),
+                np.concatenate([c.m for c, t in parts]))
+            with cls._combined_lock:
+                if len(cls._combined) >= 64:
+                    cls._combined.pop(next(iter(cls._combined)))
+                cls._combined[key] = ([c for c, t in parts], self)
+        else:
+            self._finish(n)
+
+        return self
+
+    # Recent results of combine, keyed by n0 and the parts; shared between
+    #  threads, so only accessed with the lock held
+    _combined = {}
+    _combined_lock = threading.Lock()
+
+    def _moved(self, center, optical_center):
+        # Copy with new layer positions, which must be in the same order
+        moved = CompiledStack.__new__(CompiledStack)
+        vars(moved).update(vars(self))
+        moved.center = center
+        moved.optical_center = optical_center
+        moved._positions()
+        perfect = np.where(self.kind == PERFECT)[0]
+        if len(perfect):
+            moved.layer_M = self.layer_M.copy()
+            moved._perfect_M(perfect)
+        moved._freeze()
+        return moved
+
+    def _finish(self, n, M=None, m=None):
+        # Derived arrays, from the layers and the indices.  If given, M and m
+        #  are the layer matrices and index ratios of the parts, which are
+        #  only recomputed for the layers where the index ratio changed.
+        S = len(self.kind)
+        shape = np.shape(self.λ)
+        self._positions()
+        self.sgn = np.sign(self.R)
+        self.n = np.asarray(n, dtype='d')
+        self.m = self.n[:-1] / self.n[1:]
+
+        # Paraxial matrices; see Surface.M and PerfectLens.M
+        if M is None:
+            M = np.zeros((S,) + shape + (2, 2))
+            M[..., 0, 0] = 1
+            i = np.arange(S)
+        else:
+            i = np.where((self.m != m).reshape(S, -1).any(-1))[0]
+
+        M[i, ..., 1, 1] = self.m[i]
+        i = i[self.kind[i] == SPHERE]
+        n1, n2 = self.n[i], self.n[i+1]
+        M[i, ..., 1, 0] = (n1-n2)/(self.R[i].reshape((-1,) + (1,) * len(shape))*n2)
+        self.layer_M = M
+        self._perfect_M(np.where(self.kind == PERFECT)[0])
+        self._freeze()
+
+    def _positions(self):
+        self.C = self.center + self.R[:, np.newaxis] * (0, 0, 1)
+        self.meridional = bool((self.center[:, 1] == 0).all() and (self.optical_center[:, 1] == 0).all())
+
+    def _perfect_M(self, perfect):
+        for i in perfect:
+            d = self.optical_center[i, 2] - self.center[i, 2]
+            f = self.f[i]
+            self.layer_M[i] = np.array([(1+d/f, d**2/f), (-1/f, 1-d/f)])
+
+    def _freeze(self):
+        for v in vars(self).values():
+            if isinstance(v, np.ndarray):
+                v.flags.writeable = False
+
+    def __len__(self):
+        return len(self.kind)
+
+    def layers_before(self, z_final):
+        '''Number of layers traced before stopping at z_final.'''
+        past = self.center[:, 2] > z_final
+        return int(np.argmax(past)) if past.any() else len(self)
+
+    def trace_points(self, S=None):
+        '''Number of points in the trace of the first S layers.'''
+        kind = self.kind[:S]
+        return 2 + len(kind) + int((kind == PERFECT).sum())
+
+    def trace_rays(self, X, N, z_final, jit=False, out=None, workspace=None, dtype='d', meridional=None,
+            opl=None):
+        '''Trace rays through the stack; see OpticalStack.trace_rays.'''
+        if (out is not None or workspace is not None) and not jit:
+            return self._trace_inplace(X, N, z_final, out, workspace, dtype, opl)
+        return self._trace(X, N, z_final, jit, out=out, dtype=dtype, meridional=meridional, opl=opl)[0]
+
+    def trace_chunks(self, X, N, z_final, chunksize=65536, points=None, jit=False, dtype='d'):
+        '''Trace rays in chunks; see OpticalStack.trace_chunks.'''
+        for X, N in _chunks(X, N, chunksize):
+            yield self._trace(X, N, z_final, jit, points, dtype=dtype)
+
+    def trace_reduce(self, X, N, z_final, reducers, chunksize=65536, jit=False, dtype='d'):
+        '''Trace rays in chunks, updating a list of reducers; see
+        OpticalStack.trace_reduce.'''
+        need_opl = any(getattr(r, 'uses_opl', False) for r in reducers)
+        shape = np.shape(self.λ) + (1,)
+        n = self.n[self.layers_before(z_final)].reshape(shape)
+        λ = np.reshape(self.λ, shape)
+
+        for X0, N0 in _chunks(X, N, chunksize):
+            opl = np.zeros(np.shape(self.λ) + X0.shape[:-1], dtype) if need_opl else None
+            trace, Nf = self._trace(X0, N0, z_final, jit, [-1], dtype=dtype, opl=opl)
+            Xf = _to_plane(trace[..., 0, :], Nf, z_final, n, opl)
+            info = dict(X0=X0, N0=norm(N0), n=n, λ=λ)
+            if need_opl:
+                info['opl'] = opl
+            for reducer in reducers:
+                reducer.update(Xf, Nf, **info)
+
+    def _trace(self, X, N, z_final, jit=False, points=None, out=None, dtype='d', meridional=None, opl=None):
+        # Returns the trace, keeping only the selected points if specified,
+        #  and the final ray directions.  If opl is given, the optical path
+        #  length of every ray to its final point is added to it.
+        S = self.layers_before(z_final)
+
+        X = np.asarray(X, dtype)
+        N = norm(np.asarray(N, dtype))
+        X = X * np.ones(N.shape, dtype)
+        N = N * np.ones(X.shape, dtype)
+
+        # Multiple wavelengths become extra leading ray dimensions
+        Λ = np.shape(self.λ)
+        if Λ:
+            X = X * np.ones(Λ + (1,) * X.ndim, dtype)
+            N = N * np.ones(X.shape, dtype)
+
+        if points is not None:
+            points = np.atleast_1d(points)
+
+        if opl is not None and opl.shape != X.shape[:-1]:
+            raise ValueError(f'opl should have shape {X.shape[:-1]} (found {opl.shape})')
+
+        if jit:
+            from . import jit as jit_backend
+            if jit_backend.HAS_NUMBA:
+                with instrument.section('trace_rays (jit)'):
+                    out, N = jit_backend.trace_rays(self, X, N, z_final, S, out, opl)
+                if points is not None:
+                    out = out[..., points, :]
+                return out, N
+
+        rays_meridional = not (X[..., 1].any() or N[..., 1].any())
+        if meridional is None:
+            meridional = self.meridional and rays_meridional
+        elif meridional and not (self.meridional and rays_meridional):
+            raise ValueError('meridional tracing requires layers centered in the x-z plane, and rays with no y component')
+
+        # Meridional rays are traced as 2D (x, z) vectors
+        xz = slice(None, None, 2) if meridional else slice(None)
+        X3 = X
+        X = X[..., xz]
+        N = N[..., xz]
+
+        P = self.trace_points(S)
+        if points is None:
+            slot = np.arange(P)
+        else:
+            slot = np.full(P, -1)
+            slot[points] = np.arange(len(slot[points]))
+
+        shape = X3.shape[:-1] + (int((slot >= 0).sum()), 3)
+        if out is None:
+            out = np.zeros(shape, dtype) if meridional else np.empty(shape, dtype)
+        elif out.shape != shape:
+            raise ValueError(f'out should have shape {shape} (found {out.shape})')
+        elif meridional:
+            out[..., 1] = 0
+
+        def store(p, X):
+            if slot[p] >= 0:
+                out[..., slot[p], xz] = X
+
+        store(0, X)
+
+        # Pad the indices so they broadcast against the ray vectors
+        m = self.m.reshape(self.m.shape + (1,) * (X.ndim - len(Λ)))
+        if opl is not None:
+            n = self.n.reshape(self.n.shape + (1,) * (X.ndim - 1 - len(Λ)))
+
+        rec = instrument.ACTIVE
+        stats = None
+
+        p = 1
+        z = 0
+        for i in range(S):
+            if rec is not None:
+                t0, stats, live = time.perf_counter(), {}, N[..., -1] > 0
+
+            z = self.center[i, 2]
+            center = self.center[i, xz]
+            if self.kind[i] == PERFECT:
+                Xc, Xn, Nn = _perfect_lens(X, N, center, self.optical_center[i, xz], self.f[i])
+                if opl is not None:
+                    opl += n[i] * _perfect_lens_path(X, N, Xn, Nn, self.optical_center[i, xz], self.f[i],
+                        self.vergence[i])
+                store(p, Xc)
+                store(p+1, Xn)
+                p += 2
+            else:
+                Xn, Nn = _refract(X, N, center,
+                    self.R[i] if self.kind[i] == SPHERE else None, m[i], stats)
+                if opl is not None:
+                    opl += n[i] * dot(Xn - X, N)
+                Xc = Xn
+                store(p, Xn)
+                p += 1
+            X, N = Xn, Nn
+
+            if self.r_clip[i] < np.inf:
+                r = np.sqrt(((Xc[..., :-1] - center[:-1])**2).sum(-1))
+                N[r > self.r_clip[i]] = -1
+
+            if rec is not None:
+                rec.layer((i, KIND_NAMES[self.kind[i]]), time.perf_counter() - t0, live, N, **stats)
+
+        X = X.copy()
+        good = np.where(N[..., -1] > 0)
+        X[good] += (z_final - z) * N[good]/N[good][..., -1:]
+        store(p, X)
+
+        if opl is not None:
+            opl[good] += np.broadcast_to(n[S], opl.shape)[good] * (z_final - z) / N[good][..., -1]
+            opl[N[..., -1] <= 0] = np.nan
+
+        if meridional:
+            # Killed rays have N = -1 for every component
+            N3 = np.zeros(X3.shape, N.dtype)
+            N3[..., xz] = N
+            N3[..., 1] = np.where((N == -1).all(-1), -1, 0)
+            N = N3
+
+        return out, N
+
+    def _trace_inplace(self, X, N, z_final, out=None, ws=None, dtype='d', opl=None):
+        # Same as _trace, but working in place on workspace arrays
+        S = self.layers_before(z_final)
+        Λ = np.shape(self.λ)
+        X = np.asarray(X)
+        N = np.asarray(N)
+        shape = Λ + np.broadcast_shapes(X.shape, N.shape)
+
+        trace_shape = shape[:-1] + (self.trace_points(S), 3)
+        if out is None:
+            out = np.empty(trace_shape, dtype)
+        elif out.shape != trace_shape:
+            raise ValueError(f'out should have shape {trace_shape} (found {out.shape})')
+        if opl is not None and opl.shape != shape[:-1]:
+            raise ValueError(f'opl should have shape {shape[:-1]} (found {opl.shape})')
+
+        if ws is None:
+            ws = Workspace()
+
+        N = norm(N, ws.get('N0', shape, dtype), ws)
+        X0 = ws.get('X0', shape, dtype)
+        np.copyto(X0, X)
+        X = X0
+        out[..., 0, :] = X
+
+        m = self.m.reshape(self.m.shape + (1,) * (len(shape) - len(Λ)))
+        if opl is not None:
+            # The incoming rays are kept to find the path through each layer
+            n = self.n.reshape(self.n.shape + (1,) * (len(shape) - 1 - len(Λ)))
+            Xp, Np = ws.get('Xp', shape, dtype), ws.get('Np', shape, dtype)
+            path = ws.get('path', shape[:-1], dtype)
+
+        rec = instrument.ACTIVE
+        stats = None
+
+        p = 1
+        z = 0
+        for i in range(S):
+            if rec is not None:
+                t0, stats, live = time.perf_counter(), {}, N[..., 2] > 0
+
+            if opl is not None:
+                np.copyto(Xp, X)
+                np.copyto(Np, N)
+
+            z = self.center[i, 2]
+            if self.kind[i] == PERFECT:
+                Xc, X, N = _perfect_lens_inplace(X, N, self.center[i], self.optical_center[i], self.f[i], ws)
+                out[..., p, :] = Xc
+                out[..., p+1, :] = X
+                p += 2
+                if opl is not None:
+                    # Not done in place, but perfect lenses are rare
+                    path[...] = _perfect_lens_path(Xp, Np, X, N, self.optical_center[i], self.f[i],
+                        self.vergence[i])
+            else:
+                X, N = _refract_inplace(X, N, self.center[i],
+                    self.R[i] if self.kind[i] == SPHERE else None, m[i], ws, stats)
+                Xc = X
+                out[..., p, :] = X
+                p += 1
+                if opl is not None:
+                    dot(np.subtract(X, Xp, out=Xp), Np, path, ws)
+
+            if opl is not None:
+                np.add(opl, np.multiply(n[i], path, out=path), out=opl)
+
+            if self.r_clip[i] < np.inf:
+                _clip_inplace(Xc, N, self.center[i], self.r_clip[i], ws)
+
+            if rec is not None:
+                rec.layer((i, KIND_NAMES[self.kind[i]]), time.perf_counter() - t0, live, N, **stats)
+
+        good = np.greater(N[..., 2:3], 0, out=ws.get('live', shape[:-1] + (1,), bool))
+        Xf = ws.get('Xi', shape, dtype)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            np.multiply(z_final - z, N, out=Xf)
+            np.divide(Xf, N[..., 2:3], out=Xf)
+            np.add(X, Xf, out=Xf)
+        out[..., p, :] = X
+        np.copyto(out[..., p, :], Xf, where=good)
+
+        if opl is not None:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                np.multiply(n[S], z_final - z, out=path)
+                np.divide(path, N[..., 2], out=path)
+            np.add(opl, path, out=opl, where=good[..., 0])
+            np.copyto(opl, np.nan, where=np.logical_not(good[..., 0], out=ws.get('dead', shape[:-1], bool)))
+
+        return out
+
+    def M(self, z_final=None, offset=0):
+        '''Paraxial (ABCD) matrix of the stack; see OpticalStack.M.'''
+        Λ = np.shape(self.λ)
+        offset = np.asarray(offset, dtype='d')
+        pad = (1,) * offset.ndim
+
+        # The object plane stays at z = 0 when the stack is offset
+        M = np.broadcast_to(np.eye(2), Λ + offset.shape + (2, 2))
+        z = np.zeros(offset.shape)
+        done = np.zeros(offset.shape, dtype=bool)
+
+        for i in range(len(self)):
+            z1 = self.center[i, 2] + offset
+            if z_final is not None:
+                done = done | (z1 > z_final)
+            M1 = np.matmul(self.layer_M[i].reshape(Λ + pad + (2, 2)), _advance(M, z1 - z))
+            M = np.where(done[..., np.newaxis, np.newaxis], M, M1)
+            z = np.where(done, z, z1)
+
+        if z_final is None:
+            z_final = z - M[..., 0, 1] / M[..., 1, 1]
+
+        return _advance(M, z_final - z), z_final
+
+    def trace_jacobian(self, X, N, z_final):
+        '''Trace rays and compute the derivatives of their final state with
+        respect to the layer parameters; see OpticalStack.trace_jacobian.'''
+        if np.ndim(self.λ):
+            raise ValueError('derivatives can only be computed for a single wavelength')
+
+        S = self.layers_before(z_final)
+        P = 2 * S
+
+        X = np.asarray(X)
+        N = norm(N)
+        X = X * np.ones(N.shape)
+        N = N * np.ones(X.shape)
+        dX = np.zeros(X.shape[:-1] + (P, 3))
+        dN = np.zeros(X.shape[:-1] + (P, 3))
+
+        # Parameters are the z positions of each layer, followed by the radii
+        z = 0
+        dz = np.zeros((P, 1))
+        for i in range(S):
+            dc = np.zeros((P, 3))
+            dc[i, 2] = 1
+            z = self.center[i, 2]
+            dz = dc[:, 2:3]
+
+            if self.kind[i] == PERFECT:
+                Xc, dXc, X, N, dX, dN = _perfect_lens_jac(X, N, dX, dN,
+                    self.center[i], self.optical_center[i], self.f[i], dc)
+            else:
+                dR = np.zeros((P, 1))
+                dR[S + i] = 1
+                X, N, dX, dN = _refract_jac(X, N, dX, dN, self.center[i],
+                    self.R[i] if self.kind[i] == SPHERE else None, self.m[i], dc, dR)
+                Xc = X
+
+            if self.r_clip[i] < np.inf:
+                r = np.sqrt(((Xc[..., :2] - self.center[i, :2])**2).sum(-1))
+                N[r > self.r_clip[i]] = -1
+                dN[r > self.r_clip[i]] = 0
+
+        # Final projection, as in trace_rays
+        good = N[..., 2:3] > 0
+        n = N[..., np.newaxis, :]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            X1 = X + (z_final - z) * N/N[..., 2:3]
+            dX1 = dX - dz * n/n[..., 2:3] + (z_final - z) * (dN/n[..., 2:3] - n*dN[..., 2:3]/n[..., 2:3]**2)
+        X = np.where(good, X1, X)
+        dX = np.where(good[..., np.newaxis, :], dX1, dX)
+
+        return X, N, _split_params(dX, S), _split_params(dN, S)
+
+    def M_jacobian(self, z_final=None):
+        '''Paraxial matrix, focus and their derivatives with respect to the
+        layer parameters; see OpticalStack.M_jacobian.'''
+        if np.ndim(self.λ):
+            raise ValueError('derivatives can only be computed for a single wavelength')
+
+        S = len(self) if z_final is None else self.layers_before(z_final)
+        P = 2 * S
+
+        M = np.eye(2)
+        dM = np.zeros((P, 2, 2))
+        z = 0
+        dz = np.zeros(P)
+
+        for i in range(S):
+            z1 = self.center[i, 2]
+            dz1 = np.zeros(P)
+            dz1[i] = 1
+
+            # Advance by z1 - z, then apply the layer matrix
+            dM = _advance(dM, z1 - z) + (dz1 - dz)[:, np.newaxis, np.newaxis] * (M[1] * [[1], [0]])
+            M = _advance(M, z1 - z)
+
+            dL = np.zeros((P, 2, 2))
+            if self.kind[i] == SPHERE:
+                n1, n2 = self.n[i], self.n[i+1]
+                dL[S + i, 1, 0] = -(n1-n2)/(self.R[i]**2*n2)
+
+            dM = np.matmul(dL, M) + np.matmul(self.layer_M[i], dM)
+            M = np.matmul(self.layer_M[i], M)
+            z, dz = z1, dz1
+
+        if z_final is None:
+            z_final = z - M[0, 1] / M[1, 1]
+            dz_final = dz - (dM[:, 0, 1] * M[1, 1] - M[0, 1] * dM[:, 1, 1]) / M[1, 1]**2
+        else:
+            dz_final = np.zeros(P)
+
+        dM = _advance(dM, z_final - z) + (dz_final - dz)[:, np.newaxis, np.newaxis] * (M[1] * [[1], [0]])
+        M = _advance(M, z_final - z)
+
+        return M, z_final, _split_params(dM, S, 0), _split_params(dz_final, S, 0)
+
+
+def _chunks(X, N, chunksize):
+    # Flatten the (broadcast) rays, and generate them chunksize at a time
+    X = np.asarray(X)
+    N = np.asarray(N)
+    shape = np.broadcast_shapes(X.shape, N.shape)[:-1] or (1,)
+    X = np.broadcast_to(X, shape + (3,))
+    N = np.broadcast_to(N, shape + (3,))
+
+    total = int(np.prod(shape))
+    for start in range(0, total, chunksize):
+        i = np.unravel_index(np.arange(start, min(start + chunksize, total)), shape)
+        yield X[i], N[i]
+
+
+def _to_plane(X, N, z_final, n, opl=None):
+    # The final trace step ends at z_final - z_vertex past the last surface,
+    #  so for a curved surface the points are off the plane by its sag;
+    #  move them along the rays onto z_final (adding the path to opl).
+    good = N[..., 2] > 0
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = np.where(good, (z_final - X[..., 2]) / N[..., 2], 0)
+    X = X + t[..., np.newaxis] * N
+    X[..., 2] = np.where(good, z_final, X[..., 2])
+    if opl is not None:
+        opl += n * t
+    return X
+
+
+def _split_params(d, S, axis=-2):
+    # Split derivatives along the parameter axis into a dictionary: z
+    #  positions, radii and thicknesses (the gap before each layer, with the
+    #  following layers moving with it).
+    d = np.moveaxis(d, axis, 0)
+    dz = d[:S]
+    dt = np.cumsum(dz[::-1], axis=0)[::-1]
+    return {k: np.moveaxis(v, 0, axis) for k, v in (('z', dz), ('R', d[S:]), ('t', dt))}
+
+
+def _advance(M, d):
+    # Non-mutating equivalent of surface.advance_M, for stacked matrices
+    d = np.asarray(d)[..., np.newaxis]
+    return np.stack([M[..., 0, :] + d * M[..., 1, :], M[..., 1, :]], axis=-2)
+
+
+class StackBatch:
+    '''A batch of optical stacks, compiled at a single wavelength, which are
+    traced together with the stack as a leading ray dimension.
+
+    All stacks must have the same number of layers, and may only contain
+    (planar or spherical) Surface layers.  The arrays have the same meaning
+    as for CompiledStack, with an extra leading (batch) axis; planar surfaces
+    have R = 0.
+
+    Parameters
+    ----------
+    stacks : list of OpticalStack or CompiledStack
+    λ : float
+        Wavelength (ignored for stacks which are already compiled).
+    '''
+
+    def __init__(self, stacks, λ=DEFAULT_λ):
+        compiled = [s if isinstance(s, CompiledStack) else s.compile(λ) for s in stacks]
+
+        if len(set(len(c) for c in compiled)) > 1:
+            raise ValueError('all stacks in a batch must have the same number of layers')
+        if any(np.ndim(c.λ) for c in compiled):
+            raise ValueError('stacks in a batch must be compiled for a single wavelength')
+        if any((c.kind == PERFECT).any() for c in compiled):
+            raise ValueError('batches of stacks may not contain PerfectLens layers')
+
+        self.center = np.array([c.center for c in compiled])
+        self.R = np.array([c.R for c in compiled])
+        self.r_clip = np.array([c.r_clip for c in compiled])
+        self.m = np.array([c.m for c in compiled])
+        self.layer_M = np.array([c.layer_M for c in compiled])
+
+    def __len__(self):
+        return len(self.center)
+
+    def take(self, indices):
+        '''Return a new batch with the selected stacks (which may be
+        repeated).'''
+        new = object.__new__(StackBatch)
+        new.__dict__.update({k: v[indices] for k, v in self.__dict__.items()})
+        return new
+
+    def offset(self, dz, layers=slice(None)):
+        '''Return a copy of the batch with the selected layers of each stack
+        moved along z by dz (an array with one entry per stack).'''
+        new = object.__new__(StackBatch)
+        new.__dict__.update(self.__dict__)
+        new.center = self.center.copy()
+        new.center[:, layers, 2] += np.asarray(dz)[:, np.newaxis]
+        return new
+
+    def trace_rays(self, X, N, z_final):
+        '''Trace the same rays through every stack in the batch; the output
+        has shape (len(batch),) + rays + (layers + 2, 3).'''
+        if (self.center[..., 2] > z_final).any():
+            raise ValueError('z_final must be after the last layer of every stack in a batch')
+
+        X = np.asarray(X)
+        N = norm(N)
+        X = X * np.ones(N.shape)
+        N = N * np.ones(X.shape)
+
+        K, S = self.R.shape
+        X = X * np.ones((K,) + (1,) * X.ndim)
+        N = N * np.ones(X.shape)
+
+        out = np.empty(X.shape[:-1] + (S + 2, 3))
+        out[..., 0, :] = X
+
+        # Per-layer arrays, padded to broadcast against the rays
+        pad = (1,) * (X.ndim - 1)
+        center = self.center.reshape((K, S) + pad[:-1] + (3,))
+        R = self.R.reshape((K, S) + pad)
+        m = self.m.reshape((K, S) + pad)
+
+        rec = instrument.ACTIVE
+        stats = None
+
+        for i in range(S):
+            if rec is not None:
+                t0, stats, live = time.perf_counter(), {}, N[..., 2] > 0
+
+            X, N = _refract(X, N, center[:, i], R[:, i], m[:, i], stats)
+            out[..., i+1, :] = X
+
+            r = np.sqrt(((X[..., :2] - center[:, i, ..., :2])**2).sum(-1))
+            N[r > self.r_clip[:, i].reshape((K,) + pad[:-1])] = -1
+
+            if rec is not None:
+                rec.layer((i, 'batch'), time.perf_counter() - t0, live, N, **stats)
+
+        X = X.copy()
+        z = self.center[:, -1, 2].reshape((K,) + pad)
+        good = N[..., 2:3] > 0
+        with np.errstate(invalid='ignore', divide='ignore'):
+            X = np.where(good, X + (z_final - z) * N/N[..., 2:3], X)
+        out[..., S+1, :] = X
+
+        return out
+
+    def M(self, z_final=None):
+        '''Paraxial (ABCD) matrices of every stack; see OpticalStack.M.  The
+        output has shape (len(batch), 2, 2).'''
+        K, S = self.R.shape
+        M = np.broadcast_to(np.eye(2), (K, 2, 2))
+        z = np.zeros(K)
+
+        if z_final is not None and (self.center[..., 2] > z_final).any():
+            raise ValueError('z_final must be after the last layer of every stack in a batch')
+
+        for i in range(S):
+            z1 = self.center[:, i, 2]
+            M = np.matmul(self.layer_M[:, i], _advance(M, z1 - z))
+            z = z1
+
+        if z_final is None:
+            z_final = z - M[..., 0, 1] / M[..., 1, 1]
+
+        return _advance(M, z_final - z), z_final
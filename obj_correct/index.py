@@ -17,36 +17,135 @@
 import numpy as np
 import os
 import json
+import threading
+from collections import OrderedDict
+from . import catalog
+from . import instrument
 
 GLASS_DATA = os.path.join(os.path.split(__file__)[0], "data", "glass.json")
+GLASS_TABLE = catalog.table_fn(GLASS_DATA)
 
-with open(GLASS_DATA, 'r') as f:
-    INDEX_MODELS = json.load(f)
+# The glass database is only loaded on the first lookup; use models() to
+#  access it.
+_INDEX_MODELS = None
+
+def models():
+    '''Return the dictionary of known materials, loading it if needed.
+
+    If the packed catalog (glass.npy) exists it is memory mapped, and the
+    values are rows of the table; otherwise they are dictionaries from the
+    JSON file.  Either way, they are replaced by Sellmeier objects on first
+    use.'''
+    global _INDEX_MODELS
+    if _INDEX_MODELS is None:
+        if os.path.exists(GLASS_TABLE):
+            table = catalog.load(GLASS_TABLE)
+            _INDEX_MODELS = dict(zip(table['name'].tolist(), table))
+        else:
+            with open(GLASS_DATA, 'r') as f:
+                _INDEX_MODELS = json.load(f)
+    return _INDEX_MODELS
+
+def __getattr__(name):
+    # Backwards compatibility: INDEX_MODELS used to be loaded at import.
+    if name == 'INDEX_MODELS':
+        return models()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 class Sellmeier:
     def __init__(self, A=1, B=None, C=None):
         self.A = A
-        self.B = B
-        self.C = C
+        self.B = np.asarray(B, dtype='d')
+        self.C = np.asarray(C, dtype='d')
 
     def __call__(self, λ):
-        n2 = self.A
-        λ2 = λ**2
-        for B, C in zip(self.B, self.C):
-            n2 += B * λ2 / (λ2 - C)
+        # All of the coefficients are evaluated at once, along a new last axis
+        λ2 = np.asarray(λ)[..., np.newaxis]**2
+        return np.sqrt(self.A + (self.B * λ2 / (λ2 - self.C)).sum(-1))
+
+
+class LRUCache:
+    '''A simple least-recently-used cache, which counts hits and misses.
+
+    It may be shared between threads; values are computed outside of the
+    lock, so two threads may both compute a missing value.'''
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.data = OrderedDict()
+            self.hits = 0
+            self.misses = 0
+
+    def get(self, key, func):
+        '''Return the cached value for key, calling func() to compute it if
+        it is missing.'''
+        with self.lock:
+            val = self.data.get(key, _MISSING)
+            if val is not _MISSING:
+                self.hits += 1
+                self.data.move_to_end(key)
+                return val
+            self.misses += 1
+
+        val = func()
+        with self.lock:
+            self.data[key] = val
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+        return val
+
+    def info(self):
+        with self.lock:
+            return dict(hits=self.hits, misses=self.misses, maxsize=self.maxsize,
+                size=len(self.data))
+
+
+_MISSING = object()
+
+
+# Cache for the index of named materials, keyed by (material, λ)
+CACHE = LRUCache()
+
+
+def cache_info():
+    '''Return the hit/miss counts and size of the material index cache.'''
+    return CACHE.info()
+
+
+def _λ_key(λ):
+    if isinstance(λ, (int, float)):
+        return float(λ)
+    else:
+        λ = np.asarray(λ, dtype='d')
+        return (λ.shape, λ.tobytes())
+
 
-        return np.sqrt(n2)
+def _eval_material(n, λ):
+    model = models()[n]
+    if isinstance(model, dict):
+        model = Sellmeier(**model)
+        models()[n] = model
+    elif isinstance(model, np.void):
+        A = model['A'] if 'A' in model.dtype.names else 1
+        model = Sellmeier(A, model['B'], model['C'])
+        models()[n] = model
 
+    val = model(λ)
+    if isinstance(val, np.ndarray):
+        # Cached arrays are shared, so they should not be modified!
+        val.flags.writeable = False
+    return val
 
 
 def eval(n, λ):
     if isinstance(n, str):
-        if n in INDEX_MODELS:
-            model = INDEX_MODELS[n]
-            if isinstance(model, dict):
-                model = Sellmeier(**model)
-                INDEX_MODELS[n] = model
-            return model(λ)
+        if n in models():
+            with instrument.section('index.eval'):
+                return CACHE.get((n, _λ_key(λ)), lambda: _eval_material(n, λ))
         else:
             raise ValueError(f'Index specified as "{n}", but this is not a known material')
     elif hasattr(n, '__call__'):
@@ -0,0 +1,143 @@
+#!/usr/bin/python3
+#
+# Copyright 2022 Dustin Kleckner
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Opt-in instrumentation of the hot paths.  Nothing is recorded unless a
+#  Recorder is active; the instrumented code only checks whether ACTIVE is
+#  None, once per call.  Usage:
+#
+#      with instrument.record() as rec:
+#          optics.trace_rays(X, N, z_final)
+#      print(rec.summary())
+#
+# Layers are identified by their index in the stack and their type (index
+#  None for Surface.trace_rays called directly), so traces of different stacks
+#  with the same layout are combined.  Only the current process is recorded
+#  (not the workers of a process pool), and the jit version of trace_rays is
+#  recorded as a whole, not per layer.
+
+import time
+import numpy as np
+from contextlib import contextmanager
+
+ACTIVE = None
+
+LAYER_FIELDS = ('calls', 'rays', 'live', 'miss', 'tir', 'clip', 'time')
+
+
+class Recorder:
+    '''Counts and times of the instrumented code.
+
+    Attributes
+    ----------
+    layers : dict
+        Per-layer statistics, keyed by (index, kind); each is a dict with
+        the number of calls, rays processed, rays live on entry, rays killed
+        by missing the surface (miss), total internal reflection (tir) or
+        clipping (clip), and the wall time in seconds.
+    sections : dict
+        Number of calls and wall time of larger operations (compilation,
+        index evaluation, fits, ...), keyed by name.  Sections may be
+        nested, and their times include any nested sections.
+    '''
+    def __init__(self):
+        self.layers = {}
+        self.sections = {}
+
+    def layer(self, key, t, live, N, miss=0, tir=0):
+        '''Record one call of a layer, given the mask of the live rays before
+        it (which may be broadcast), and the ray directions after it; rays
+        killed by something other than a miss or TIR were clipped.'''
+        rays = N[..., -1].size
+        live = int(np.broadcast_to(live, N.shape[:-1]).sum())
+        alive = int((N[..., -1] > 0).sum())
+
+        d = self.layers.get(key)
+        if d is None:
+            d = self.layers[key] = dict.fromkeys(LAYER_FIELDS, 0)
+        d['calls'] += 1
+        d['rays'] += rays
+        d['live'] += live
+        d['miss'] += miss
+        d['tir'] += tir
+        d['clip'] += live - alive - miss - tir
+        d['time'] += t
+
+    def section(self, name, t):
+        '''Record one call of a section.'''
+        d = self.sections.setdefault(name, dict(calls=0, time=0))
+        d['calls'] += 1
+        d['time'] += t
+
+    def report(self):
+        '''Return the recorded data as a (JSON serializable) dictionary.'''
+        layers = [dict(index=i, kind=kind, **d) for (i, kind), d in
+            sorted(self.layers.items(), key=lambda item: (item[0][0] is not None, item[0]))]
+        return dict(layers=layers, sections={k: dict(v) for k, v in self.sections.items()})
+
+    def summary(self):
+        '''Return a table of the recorded data.'''
+        lines = [f'{"layer":>14s} {"calls":>8s} {"rays":>12s} {"miss":>10s} {"tir":>10s} {"clip":>10s} {"time (ms)":>11s}']
+        for d in self.report()['layers']:
+            name = f'{"-" if d["index"] is None else d["index"]} {d["kind"]}'
+            lines.append(f'{name:>14s} {d["calls"]:8d} {d["rays"]:12d} {d["miss"]:10d} {d["tir"]:10d} {d["clip"]:10d} {d["time"]*1E3:11.2f}')
+
+        lines.append('')
+        lines.append(f'{"section":>30s} {"calls":>8s} {"time (ms)":>11s}')
+        for name, d in self.sections.items():
+            lines.append(f'{name:>30s} {d["calls"]:8d} {d["time"]*1E3:11.2f}')
+
+        return '\n'.join(lines)
+
+
+@contextmanager
+def record(recorder=None):
+    '''Record the instrumented code run in this context; yields the Recorder
+    (a new one, unless specified).'''
+    global ACTIVE
+    rec = Recorder() if recorder is None else recorder
+    previous, ACTIVE = ACTIVE, rec
+    try:
+        yield rec
+    finally:
+        ACTIVE = previous
+
+
+class _Section:
+    def __init__(self, rec, name):
+        self.rec = rec
+        self.name = name
+
+    def __enter__(self):
+        self.t0 = time.perf_counter()
+
+    def __exit__(self, *args):
+        self.rec.section(self.name, time.perf_counter() - self.t0)
+
+
+class _NoSection:
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+_NO_SECTION = _NoSection()
+
+
+def section(name):
+    '''Context manager which times a named section, if recording.'''
+    return _NO_SECTION if ACTIVE is None else _Section(ACTIVE, name)
@@ -0,0 +1,218 @@
+#!/usr/bin/python3
+#
+# Copyright 2022 Dustin Kleckner
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compiled tracing of an entire OpticalStack.  Every ray is traced through
+#  all the layers of a CompiledStack in a single fused, parallel kernel.  This
+#  is used by OpticalStack.trace_rays(..., jit=True) if numba is available;
+#  otherwise the (vectorized NumPy) CompiledStack.trace_rays is used instead.
+
+import numpy as np
+from .compiled import PLANE, PERFECT
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+HAS_NUMBA = numba is not None
+
+
+def trace_rays(compiled, X, N, z_final, S, out=None, opl=None):
+    '''Trace rays through the first S layers of a CompiledStack.
+
+    X and N should already be broadcast to the same shape, including any
+    leading wavelength dimensions.  Returns the trace (the same as
+    CompiledStack.trace_rays) and the final ray directions.  If out is
+    specified, the trace is written there; it must be C contiguous.  If opl
+    is specified, the optical path length of each ray is added to it, as
+    for CompiledStack.trace_rays.'''
+    shape = X.shape[:-1]
+    L = int(np.prod(np.shape(compiled.λ)))
+
+    # Rays are stored as (wavelength, ray, xyz)
+    X = np.ascontiguousarray(X.reshape(L, -1, 3))
+    N = np.ascontiguousarray(N.reshape(L, -1, 3), dtype=X.dtype)
+    trace_shape = X.shape[:2] + (compiled.trace_points(S), 3)
+    if out is None:
+        out = np.empty(trace_shape, X.dtype)
+    elif out.shape != shape + trace_shape[2:] or not out.flags.c_contiguous:
+        raise ValueError(f'out should be a C contiguous array with shape {shape + trace_shape[2:]}')
+    else:
+        out = out.reshape(trace_shape)
+    Nf = np.empty_like(N)
+    path = np.zeros(0 if opl is None else X.shape[:2], X.dtype)
+
+    _trace_numba(X, N, compiled.kind[:S], compiled.center[:S], compiled.R[:S],
+        compiled.r_clip[:S], compiled.m[:S].reshape(S, L), compiled.f[:S],
+        compiled.optical_center[:S], compiled.vergence[:S], float(z_final), out, Nf,
+        compiled.n[:S+1].reshape(S+1, L), opl is not None, path)
+
+    if opl is not None:
+        opl += path.reshape(shape)
+
+    return out.reshape(shape + out.shape[2:]), Nf.reshape(shape + (3,))
+
+
+if HAS_NUMBA:
+    @numba.njit
+    def _conjugate_path(h0, h1, s0, s1, w):
+        # See surface._conjugate_path
+        g0, g1 = h0*w + s0, h1*w + s1
+        return ((h0*h0 + h1*h1)*w + 2*(h0*s0 + h1*s1)) / (np.sqrt(g0*g0 + g1*g1 + 1)
+            + np.sqrt(1 + s0*s0 + s1*s1))
+
+    @numba.njit(parallel=True)
+    def _trace_numba(X, N, kind, center, R, r_clip, m, f, oc, a, z_final, out, Nf, n, do_path, path):
+        # X, N, out and path have (wavelength, ray) leading dimensions; these
+        #  are flattened for the parallel loop.  The optical path is only
+        #  computed if do_path (otherwise path is empty).
+        nr = X.shape[1]
+        X = X.reshape(-1, 3)
+        N = N.reshape(-1, 3)
+        out = out.reshape(-1, out.shape[2], 3)
+        Nf = Nf.reshape(-1, 3)
+        path = path.reshape(-1)
+
+        for i in numba.prange(X.shape[0]):
+            k = i // nr
+            x0, x1, x2 = X[i, 0], X[i, 1], X[i, 2]
+            n0, n1, n2 = N[i, 0], N[i, 1], N[i, 2]
+            out[i, 0, 0] = x0
+            out[i, 0, 1] = x1
+            out[i, 0, 2] = x2
+            p = 1
+            z = 0.0
+            w = 0.0
+
+            for j in range(kind.shape[0]):
+                z = center[j, 2]
+                xc0, xc1 = x0, x1
+
+                if kind[j] == PERFECT:
+                    if n2 > 0:
+                        s0, s1, s2 = n0/n2, n1/n2, n2/n2
+
+                        # Project to surface
+                        d = center[j, 2] - x2
+                        xc0, xc1, xc2 = x0 + d*s0, x1 + d*s1, x2 + d*s2
+                        out[i, p, 0] = xc0
+                        out[i, p, 1] = xc1
+                        out[i, p, 2] = xc2
+
+                        # Project to virtual lens center
+                        d = oc[j, 2] - x2
+                        x0, x1, x2 = x0 + d*s0, x1 + d*s1, x2 + d*s2
+
+                        if do_path:
+                            # Path to the center, and the phase of the lens;
+                            #  see surface._perfect_lens_path
+                            h0, h1 = x0 - oc[j, 0], x1 - oc[j, 1]
+                            φ = (_conjugate_path(h0, h1, s0 - h0/f[j], s1 - h1/f[j], 1/f[j] - a[j])
+                                - _conjugate_path(h0, h1, s0, s1, -a[j]))
+                            w += n[j, k] * (d/n2 + φ)
+                        y0, y1, y2 = x0, x1, x2
+
+                        # Focus
+                        s0 -= (x0 - oc[j, 0]) / f[j]
+                        s1 -= (x1 - oc[j, 1]) / f[j]
+
+                        # Propigate to clip plane
+                        d = center[j, 2] - x2
+                        x0, x1, x2 = x0 + d*s0, x1 + d*s1, x2 + d*s2
+
+                        l = np.sqrt(s0*s0 + s1*s1 + s2*s2)
+                        n0, n1, n2 = s0/l, s1/l, s2/l
+                        if do_path:
+                            w += n[j, k] * ((x0 - y0)*n0 + (x1 - y1)*n1 + (x2 - y2)*n2)
+                    else:
+                        out[i, p, 0] = x0
+                        out[i, p, 1] = x1
+                        out[i, p, 2] = x2
+
+                    p += 1
+
+                elif n2 > 0:
+                    hit = True
+                    ns0, ns1, ns2 = 0.0, 0.0, -1.0
+                    if kind[j] == PLANE:
+                        d = (center[j, 2] - x2) / n2
+                        x0, x1, x2 = x0 + d*n0, x1 + d*n1, x2 + d*n2
+                    else:
+                        c0, c1, c2 = center[j, 0], center[j, 1], center[j, 2] + R[j]
+                        sgn = np.sign(R[j])
+                        d0, d1, d2 = c0 - x0, c1 - x1, c2 - x2
+                        dp = d0*n0 + d1*n1 + d2*n2
+                        sqt = dp*dp - ((d0*d0 + d1*d1 + d2*d2) - R[j]*R[j])
+
+                        if sqt < 0:
+                            hit = False
+                            d = 0.0
+                        else:
+                            d = dp - sgn * np.sqrt(sqt)
+                            x0, x1, x2 = x0 + d*n0, x1 + d*n1, x2 + d*n2
+                            d0, d1, d2 = x0 - c0, x1 - c1, x2 - c2
+                            l = sgn / np.sqrt(d0*d0 + d1*d1 + d2*d2)
+                            ns0, ns1, ns2 = d0*l, d1*l, d2*l
+
+                    if do_path:
+                        w += n[j, k] * d
+
+                    if hit:
+                        # Refraction; see Surface._trace_rays
+                        cp0 = n1*ns2 - n2*ns1
+                        cp1 = n2*ns0 - n0*ns2
+                        cp2 = n0*ns1 - n1*ns0
+                        sqt = 1 - m[j, k]*m[j, k] * (cp0*cp0 + cp1*cp1 + cp2*cp2)
+
+                        if sqt < 0:
+                            n0, n1, n2 = -1.0, -1.0, -1.0
+                        else:
+                            sqt = np.sqrt(sqt)
+                            n0 = m[j, k] * (ns1*cp2 - ns2*cp1) - ns0*sqt
+                            n1 = m[j, k] * (ns2*cp0 - ns0*cp2) - ns1*sqt
+                            n2 = m[j, k] * (ns0*cp1 - ns1*cp0) - ns2*sqt
+                            l = np.sqrt(n0*n0 + n1*n1 + n2*n2)
+                            n0, n1, n2 = n0/l, n1/l, n2/l
+                    else:
+                        n0, n1, n2 = -1.0, -1.0, -1.0
+
+                    xc0, xc1 = x0, x1
+
+                out[i, p, 0] = x0
+                out[i, p, 1] = x1
+                out[i, p, 2] = x2
+                p += 1
+
+                d0, d1 = xc0 - center[j, 0], xc1 - center[j, 1]
+                if np.sqrt(d0*d0 + d1*d1) > r_clip[j]:
+                    n0, n1, n2 = -1.0, -1.0, -1.0
+
+            if n2 > 0:
+                d = z_final - z
+                x0, x1, x2 = x0 + d*n0/n2, x1 + d*n1/n2, x2 + d*n2/n2
+                if do_path:
+                    path[i] = w + n[kind.shape[0], k] * d / n2
+            elif do_path:
+                path[i] = np.nan
+
+            out[i, p, 0] = x0
+            out[i, p, 1] = x1
+            out[i, p, 2] = x2
+            Nf[i, 0] = n0
+            Nf[i, 1] = n1
+            Nf[i, 2] = n2
+else:
+    _trace_numba = None
@@ -0,0 +1,257 @@
+#!/usr/bin/python3
+#
+# Copyright 2022 Dustin Kleckner
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Pupil samplings, for building 2D ray bundles (spot diagrams, wavefronts).
+#  A sampling is a set of points (u, v) in the unit disk, which are mapped to
+#  rays from a field point with direction sines (NA/n) * (u, v), i.e. the
+#  bundle fills a cone of numerical aperture NA about the z axis.  Points are
+#  computed on demand from their index, so very large bundles can be
+#  generated in chunks without storing the whole sampling:
+#
+#      pupil = Fibonacci(10**7)
+#      for X, N in pupil.chunks(NA=0.3):
+#          ...
+#
+# Symmetric samplings only cover part of the pupil.  For an axisymmetric
+#  stack and an on-axis field point, sector=k samples 1/k of the pupil (the
+#  angles [0, 2π/k)); for a field point on the x axis of a stack centered in
+#  the x-z plane, mirror=True samples the half with v >= 0.  After tracing,
+#  unfold reconstructs the results for the whole pupil, so that the rest of
+#  the rays don't need to be traced.
+
+import numpy as np
+import math
+
+GOLDEN = (1 + np.sqrt(5)) / 2
+
+
+class Pupil:
+    '''Base class of the pupil samplings; subclasses define __len__ and
+    _coords(start, stop), which returns (u, v) for points start to stop.'''
+    sector = 1
+    mirror = False
+
+    def _symmetry(self, sector, mirror, allowed=None):
+        if mirror and sector != 1:
+            raise ValueError('mirror symmetry can not be combined with sectors')
+        if sector < 1 or (allowed is not None and sector not in allowed):
+            raise ValueError(f'sector should be one of {allowed}' if allowed is not None
+                else 'sector should be a positive integer')
+        self.sector = int(sector)
+        self.mirror = bool(mirror)
+
+    def coords(self, start=0, stop=None):
+        '''Pupil coordinates of points start to stop, shape (points, 2).'''
+        stop = len(self) if stop is None else min(stop, len(self))
+        u, v = self._coords(start, stop)
+        return np.stack([u, v], axis=-1)
+
+    def rays(self, NA, field=0, n=1, start=0, stop=None, out=None, dtype='d'):
+        '''Rays for points start to stop of the sampling, from the field point
+        (x, or (x, y), at z = 0) into a cone of numerical aperture NA, in a
+        medium of index n.
+
+        Returns X, N: contiguous arrays of shape (rays, 3), which are written
+        to out = (X, N) if specified.'''
+        s = NA / n
+        if s > 1:
+            raise ValueError('NA may not be larger than the index')
+
+        stop = len(self) if stop is None else min(stop, len(self))
+        u, v = self._coords(start, stop)
+        if out is None:
+            X, N = np.empty((len(u), 3), dtype), np.empty((len(u), 3), dtype)
+        else:
+            X, N = out
+
+        X[:] = 0
+        X[:, :np.size(field)] = field
+        N[:, 0] = s * u
+        N[:, 1] = s * v
+        N[:, 2] = np.sqrt(1 - s*s * (u*u + v*v))
+        return X, N
+
+    def chunks(self, NA, field=0, n=1, chunksize=65536, dtype='d'):
+        '''Generate the rays (see rays) chunksize at a time; chunk i starts
+        at point i * chunksize.'''
+        for start in range(0, len(self), chunksize):
+            yield self.rays(NA, field, n, start, start + chunksize, dtype=dtype)
+
+    def invariant(self, start=0, stop=None):
+        '''Mask of the points which are their own symmetric images (the
+        center, for sectors, or points with v = 0, for mirror symmetry).'''
+        p = self.coords(start, stop)
+        if self.mirror:
+            return p[:, 1] == 0
+        return (p[:, 0] == 0) & (p[:, 1] == 0)
+
+    def unfold(self, a, axis=-2, start=0, vector=True):
+        '''Reconstruct results for the whole pupil from those of a symmetric
+        sampling.
+
+        a has one entry per point along axis, starting at point start (e.g.
+        the final positions of the rays, with shape (..., rays, 3), or a
+        trace with axis=-3).  If vector, the last axis of a is an (x, y, z)
+        vector which is rotated or mirrored; otherwise the entries are just
+        repeated.  Returns a (copy of a) followed by the symmetric images of
+        every point which is not invariant.'''
+        a = np.asarray(a)
+        if self.sector == 1 and not self.mirror:
+            return a.copy()
+
+        axis = axis % a.ndim
+        b = np.compress(~self.invariant(start, start + a.shape[axis]), a, axis)
+        parts = [a]
+
+        if not vector:
+            parts += [b] * (1 if self.mirror else self.sector - 1)
+        elif self.mirror:
+            b = b.copy()
+            b[..., 1] *= -1
+            parts.append(b)
+        else:
+            for j in range(1, self.sector):
+                c, s = _rotation(2 * np.pi * j / self.sector)
+                r = b.copy()
+                r[..., 0] = c * b[..., 0] - s * b[..., 1]
+                r[..., 1] = s * b[..., 0] + c * b[..., 1]
+                parts.append(r)
+
+        return np.concatenate(parts, axis)
+
+    def unfolded_len(self):
+        '''Number of points of the whole pupil (after unfold).'''
+        copies = 1 if self.mirror else self.sector - 1
+        return len(self) + copies * int((~self.invariant()).sum())
+
+
+def _rotation(φ):
+    # cos and sin, exact for quarter turns
+    return tuple(0.0 if abs(x) < 1E-12 else x for x in (np.cos(φ), np.sin(φ)))
+
+
+def _ring_index(t, starts):
+    # Ring (or row) containing each point index, given their first indices
+    return np.searchsorted(starts, t, 'right') - 1
+
+
+class Grid(Pupil):
+    '''Square grid of n x n points across the pupil diameter (at the centers
+    of the cells), keeping those inside the unit circle.  Supports sectors of
+    1, 2 or 4, and mirror symmetry.'''
+    def __init__(self, n, sector=1, mirror=False):
+        self._symmetry(sector, mirror, (1, 2, 4))
+        self.n = n
+
+        # Points are at (a, b) / n, for integers a, b = 2i + 1 - n; each row
+        #  keeps a range of columns.  With sectors the center is point 0, and
+        #  the rest are in the angles [0, 2π/sector).
+        rows = []
+        self.center = (self.sector > 1) and (n % 2 == 1)
+        for j in range(n):
+            b = 2*j + 1 - n
+            w = math.isqrt(n*n - b*b)
+            i0, i1 = (n - w) // 2, n - (n - w) // 2
+            if b < 0 and (self.mirror or self.sector > 1):
+                continue
+            if self.sector == 4 or (self.sector == 2 and b == 0):
+                i0 = max(i0, (n + 1) // 2)
+            if i1 > i0:
+                rows.append((b, i0, i1 - i0))
+
+        self.rows = np.array(rows, dtype='i8').reshape(-1, 3)
+        self.starts = int(self.center) + np.concatenate([[0], np.cumsum(self.rows[:, 2])])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def _coords(self, start, stop):
+        t = np.arange(start, stop)
+        row = np.clip(_ring_index(t, self.starts), 0, len(self.rows) - 1)
+        b, i0, count = self.rows[row].T
+        a = 2 * (i0 + t - self.starts[row]) + 1 - self.n
+        if self.center:
+            a = np.where(t == 0, 0, a)
+            b = np.where(t == 0, 0, b)
+        return a / self.n, b / self.n
+
+
+class Hexapolar(Pupil):
+    '''Center point and rings of 6, 12, 18, ... points, with radius up to 1.
+    Supports sectors of 1, 2, 3 or 6, and mirror symmetry.'''
+    def __init__(self, rings, sector=1, mirror=False):
+        self._symmetry(sector, mirror, (1, 2, 3, 6))
+        self.rings = rings
+
+        # Ring j has points at angles π m / 3j, for m up to 6j / sector
+        #  (or m = 0 ... 3j, for mirror symmetry)
+        j = np.arange(1, rings + 1)
+        self.counts = 3*j + 1 if self.mirror else 6*j // self.sector
+        self.starts = np.concatenate([[0, 1], 1 + np.cumsum(self.counts)])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def _coords(self, start, stop):
+        t = np.arange(start, stop)
+        j = np.maximum(_ring_index(t, self.starts), 1)
+        m = np.maximum(t - self.starts[j], 0)
+        r = np.where(t == 0, 0, j / self.rings)
+        θ = np.pi * m / (3 * j)
+        u, v = r * np.cos(θ), r * np.sin(θ)
+        if self.mirror:
+            v[(m == 0) | (m == 3*j)] = 0
+        return u, v
+
+
+class Fibonacci(Pupil):
+    '''Fibonacci (golden angle) spiral of n points, which covers the pupil
+    nearly uniformly for any n.  With symmetries, the n points are spread
+    over the sector (or half of the pupil).'''
+    def __init__(self, n, sector=1, mirror=False):
+        self._symmetry(sector, mirror)
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def _coords(self, start, stop):
+        t = np.arange(start, stop)
+        r = np.sqrt((t + 0.5) / self.n)
+        θ = (np.pi if self.mirror else 2 * np.pi / self.sector) * ((t / GOLDEN**2) % 1)
+        return r * np.cos(θ), r * np.sin(θ)
+
+
+class Random(Pupil):
+    '''n points, uniformly distributed at random over the pupil (or its
+    sector or half).  Any chunk of points can be generated independently, and
+    the result is the same for the same seed.'''
+    def __init__(self, n, sector=1, mirror=False, seed=None):
+        self._symmetry(sector, mirror)
+        self.n = n
+        self.seed = np.random.SeedSequence(seed)
+
+    def __len__(self):
+        return self.n
+
+    def _coords(self, start, stop):
+        # Each point takes two draws, so start by skipping those before it
+        bits = np.random.PCG64(self.seed)
+        bits.advance(2 * start)
+        U = np.random.Generator(bits).random((max(stop - start, 0), 2))
+        r = np.sqrt(U[:, 0])
+        θ = (np.pi if self.mirror else 2 * np.pi / self.sector) * U[:, 1]
+        return r * np.cos(θ), r * np.sin(θ)
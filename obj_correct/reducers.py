@@ -0,0 +1,323 @@
+#!/usr/bin/python3
+#
+# Copyright 2022 Dustin Kleckner
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Reducers accumulate statistics of ray bundles one chunk at a time, so that
+#  very large bundles can be traced (see OpticalStack.trace_reduce) without
+#  storing every ray.  Each chunk is passed to update(X, N, **info), where X
+#  and N are the final ray positions (on the plane z = z_final) and
+#  directions, with shape (..., rays, 3); any leading (wavelength) dimensions are kept in the
+#  result.  Rays which did not make it through the stack (N[..., 2] <= 0) are
+#  ignored.  info contains:
+#
+#      X0, N0 : the initial rays, shape (rays, 3), with N0 normalized
+#      n, λ : the index after the last layer and the wavelength, with shape
+#          (..., 1), so they broadcast against the rays
+#      opl : the optical path length of each ray to X, only if the reducer
+#          has uses_opl = True (it is not computed otherwise)
+#
+# Lengths are in mm and wavelengths in μm, as elsewhere.
+
+import numpy as np
+
+
+def _good(N):
+    return N[..., 2] > 0
+
+
+class Centroid:
+    '''Mean position of the rays.'''
+    def __init__(self):
+        self.n = 0
+        self.sum = 0
+
+    def update(self, X, N, **info):
+        good = _good(N)
+        self.n = self.n + good.sum(-1)
+        self.sum = self.sum + (X * good[..., np.newaxis]).sum(-2)
+
+    def result(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum / np.asarray(self.n)[..., np.newaxis]
+
+
+class _Moments:
+    # Count, means and co-moment matrix of several quantities per ray, with
+    #  shape (..., rays, k).  Chunks are combined with the pairwise update of
+    #  Chan et al., which avoids the loss of precision of accumulating raw
+    #  second moments.
+    def __init__(self):
+        self.n = 0
+        self.mean = 0
+        self.C = 0
+
+    def update(self, V, good):
+        g = good[..., np.newaxis]
+        V = np.where(g, V, 0)
+        c = good.sum(-1)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = V.sum(-2) / c[..., np.newaxis]
+            mean = np.where(c[..., np.newaxis] > 0, mean, 0)
+            D = np.where(g, V - mean[..., np.newaxis, :], 0)
+            C = np.einsum('...ri,...rj->...ij', D, D)
+
+            n_tot = self.n + c
+            delta = mean - self.mean
+            w = np.where(n_tot > 0, c / n_tot, 0)
+            self.mean = self.mean + delta * w[..., np.newaxis]
+            self.C = self.C + C + (delta[..., :, np.newaxis] * delta[..., np.newaxis, :]
+                * (self.n * w)[..., np.newaxis, np.newaxis])
+            self.n = n_tot
+
+
+class RMSSpot:
+    '''RMS (transverse) radius of the rays about their centroid.'''
+    def __init__(self):
+        self.moments = _Moments()
+
+    def update(self, X, N, **info):
+        self.moments.update(X[..., :2], _good(N))
+
+    def result(self):
+        C = self.moments.C
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt((C[..., 0, 0] + C[..., 1, 1]) / self.moments.n)
+
+
+class Histogram:
+    '''2D histogram of the (x, y) ray positions, with fixed bins.
+
+    Parameters
+    ----------
+    bins : int or (int, int)
+        Number of bins in x and y.
+    range : ((xmin, xmax), (ymin, ymax))
+        Extent of the histogram; rays outside are not counted.
+    '''
+    def __init__(self, bins, range):
+        self.bins = bins
+        self.range = range
+        self.counts = None
+
+    def update(self, X, N, **info):
+        good = _good(N)
+        shape = X.shape[:-2]
+        if self.counts is None:
+            nx, ny = np.broadcast_to(self.bins, 2)
+            self.counts = np.zeros(shape + (nx, ny), dtype='i8')
+
+        for i in np.ndindex(shape):
+            x = X[i][good[i]]
+            self.counts[i] += np.histogram2d(x[:, 0], x[:, 1], self.bins,
+                self.range)[0].astype('i8')
+
+    def edges(self):
+        '''Bin edges in x and y.'''
+        nx, ny = np.broadcast_to(self.bins, 2)
+        return (np.linspace(*self.range[0], nx + 1),
+            np.linspace(*self.range[1], ny + 1))
+
+    def result(self):
+        return self.counts
+
+
+class Aberrations:
+    '''Longitudinal and transverse aberration as a function of NA, for a
+    bundle from an on-axis object point, binned by the NA of the initial rays
+    (n0 times the sine of their angle to the axis).
+
+    Parameters
+    ----------
+    z_focus : float or array
+        Reference image plane (e.g. the paraxial focus), which may have the
+        shape of the wavelengths.
+    edges : array
+        Edges of the NA bins.
+    n0 : float or array
+        Index of the object space (which may have the shape of the
+        wavelengths).
+
+    The result is a dict with the number of rays in each bin (n), their mean
+    NA, longitudinal aberration (LA, the distance from z_focus to where they
+    cross the axis) and transverse aberration (TA, their signed radial
+    position at z_focus).
+    '''
+    def __init__(self, z_focus, edges, n0=1):
+        self.z_focus = z_focus
+        self.edges = np.asarray(edges)
+        self.n0 = n0
+        self.sums = None
+
+    def update(self, X, N, X0, N0, **info):
+        good = _good(N)
+        shape = good.shape[:-1]
+        z_focus = np.reshape(self.z_focus, np.shape(self.z_focus) + (1,))
+
+        # Radial direction of each ray in the pupil
+        ρ = np.sqrt(N0[..., 0]**2 + N0[..., 1]**2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            e = np.where(ρ[..., np.newaxis] > 0, N0[..., :2] / ρ[..., np.newaxis], 0)
+            r = (X[..., :2] * e).sum(-1)
+            dr = (N[..., :2] * e).sum(-1)
+            LA = X[..., 2] - r * N[..., 2] / dr - z_focus
+            TA = r + (z_focus - X[..., 2]) * dr / N[..., 2]
+        NA = np.reshape(self.n0, np.shape(self.n0) + (1,)) * ρ
+
+        # Bin by NA, with the wavelengths as separate groups of bins
+        nb = len(self.edges) - 1
+        b = np.digitize(NA, self.edges) - 1
+        inside = (b >= 0) & (b < nb)
+        use = good & inside & np.isfinite(LA) & np.isfinite(TA)
+        groups = int(np.prod(shape))
+        index = (np.arange(groups).reshape(shape + (1,)) * nb + np.where(inside, b, 0)).ravel()
+
+        sums = []
+        for w in (use, use * NA, np.where(use, LA, 0), np.where(use, TA, 0)):
+            w = np.broadcast_to(w, use.shape).ravel()
+            sums.append(np.bincount(index, w, groups * nb).reshape(shape + (nb,)))
+        sums = np.array(sums)
+        self.sums = sums if self.sums is None else self.sums + sums
+
+    def result(self):
+        n, NA, LA, TA = self.sums
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return dict(n=n.astype('i8'), NA=NA/n, LA=LA/n, TA=TA/n)
+
+
+class OPD:
+    '''Optical path difference of the rays, relative to a spherical wave
+    converging on a reference point (e.g. the paraxial focus).
+
+    The path of each ray is extended to the plane through the reference
+    point normal to it, so the result does not depend on where the trace
+    ends (it is the reference sphere in the limit of a distant exit pupil).
+    Piston (the mean) is removed; the result is a dict with the RMS and peak
+    to valley OPD, in waves, and the number of rays.
+
+    Parameters
+    ----------
+    point : (3,) array
+        The reference point; may have leading dimensions matching the
+        wavelengths.
+    '''
+    uses_opl = True
+
+    def __init__(self, point):
+        self.point = np.asarray(point)
+        self.moments = _Moments()
+        self.min = np.inf
+        self.max = -np.inf
+
+    def update(self, X, N, opl, n, λ, **info):
+        good = _good(N)
+        P = self.point.reshape(self.point.shape[:-1] + (1, 3))
+
+        # Path in waves (lengths are in mm, λ in μm)
+        W = (opl + n * ((P - X) * N).sum(-1)) / (λ * 1E-3)
+        self.moments.update(W[..., np.newaxis], good)
+        self.min = np.minimum(self.min, np.where(good, W, np.inf).min(-1))
+        self.max = np.maximum(self.max, np.where(good, W, -np.inf).max(-1))
+
+    def result(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return dict(rms=np.sqrt(self.moments.C[..., 0, 0] / self.moments.n), pv=self.max - self.min,
+                n=np.asarray(self.moments.n))
+
+
+class RMSSpotFocus:
+    '''RMS spot radius (as for RMSSpot) as a function of the image plane.
+
+    Past the last layer the rays are straight lines, so the mean square
+    radius is a quadratic function of the plane z, which is found exactly
+    from the moments of the ray positions and slopes; the rays only need to
+    be traced once.  The result is a dict with the plane of the smallest RMS
+    radius (z), the RMS radius there (rms), and the number of rays (n).
+
+    Parameters
+    ----------
+    z_ref : float
+        Plane the moments are referred to (e.g. the end of the trace).
+    z_min : float
+        The best plane is restricted to z >= z_min (e.g. the last layer, as
+        the rays are not straight lines before it).
+    '''
+    def __init__(self, z_ref=0, z_min=-np.inf):
+        self.z_ref = z_ref
+        self.z_min = z_min
+        self.moments = _Moments()
+
+    def update(self, X, N, **info):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            s = N[..., :2] / N[..., 2:3]
+            x = X[..., :2] + (self.z_ref - X[..., 2:3]) * s
+        self.moments.update(np.concatenate([x, s], -1), _good(N))
+
+    def _quadratic(self):
+        # Mean square radius is a + 2 b dz + c dz^2, for dz = z - z_ref
+        C = self.moments.C
+        return C[..., 0, 0] + C[..., 1, 1], C[..., 0, 2] + C[..., 1, 3], C[..., 2, 2] + C[..., 3, 3]
+
+    def rms(self, z):
+        '''RMS radius at the planes z (an array), with shape
+        λ.shape + z.shape.'''
+        a, b, c = (np.reshape(v, np.shape(v) + (1,) * np.ndim(z)) for v in self._quadratic())
+        n = np.reshape(self.moments.n, np.shape(self.moments.n) + (1,) * np.ndim(z))
+        dz = np.asarray(z) - self.z_ref
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.sqrt(np.maximum(a + 2*b*dz + c*dz*dz, 0) / n)
+
+    def result(self):
+        a, b, c = self._quadratic()
+        with np.errstate(invalid='ignore', divide='ignore'):
+            z = np.maximum(self.z_ref - b / c, self.z_min)
+            dz = z - self.z_ref
+            rms = np.sqrt(np.maximum(a + 2*b*dz + c*dz*dz, 0) / self.moments.n)
+        return dict(z=z, rms=rms, n=np.asarray(self.moments.n))
+
+
+class OPDFocus(RMSSpotFocus):
+    '''RMS optical path difference (as for OPD, in waves) as a function of
+    the image plane, for a reference point at (x, y) in each plane.
+
+    The path to the reference sphere is linear in the z of the reference
+    point, so the mean square OPD is quadratic in it, and its minimum is
+    found exactly as for RMSSpotFocus; the result has the same form.
+
+    Parameters
+    ----------
+    z_ref, z_min : float
+        As for RMSSpotFocus.
+    point : (x, y)
+        Transverse position of the reference point.
+    '''
+    uses_opl = True
+
+    def __init__(self, z_ref=0, z_min=-np.inf, point=(0, 0)):
+        super().__init__(z_ref, z_min)
+        self.point = np.asarray(point)
+
+    def update(self, X, N, opl, n, λ, **info):
+        # W = a + b dz, in waves, for the reference point at z_ref + dz
+        P = np.zeros(self.point.shape[:-1] + (1, 3))
+        P[..., :2] = self.point.reshape(self.point.shape[:-1] + (1, 2))
+        P[..., 2] = self.z_ref
+        a = (opl + n * ((P - X) * N).sum(-1)) / (λ * 1E-3)
+        b = n * N[..., 2] / (λ * 1E-3)
+        self.moments.update(np.stack(np.broadcast_arrays(a, b), -1), _good(N))
+
+    def _quadratic(self):
+        C = self.moments.C
+        return C[..., 0, 0], C[..., 0, 1], C[..., 1, 1]
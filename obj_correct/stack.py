@@ -15,15 +15,39 @@
 # limitations under the License.
 
 import numpy as np
+import threading
 from . import DEFAULT_λ
-from .surface import Surface, advance_M
-import matplotlib.pyplot as plt
-from .vector import ensure_3D, norm
+from .surface import Surface
+from .compiled import CompiledStack
+from .vector import ensure_3D
 from . import index
+from . import instrument
+from . import reducers
+
+# Guards the compiled caches of the stacks, which may be shared between
+#  threads (e.g. by stock.sweep); compiling is done outside of it.
+_CACHE_LOCK = threading.Lock()
 
 class OpticalStack:
+    # A stack built only from other stacks (including offsets and flips of
+    #  them) is a view: it keeps a list of (stack, transforms) parts, where
+    #  transforms are (sign, shift) pairs as in CompiledStack.combine, and
+    #  only creates its layers if they are asked for.  It follows any
+    #  changes to the stacks it was made from: the layers are rebuilt if the
+    #  signatures of the parts change.  Compiling a view combines the
+    #  (cached) compiled forms of its parts, so re-positioning a lens does
+    #  not create any new Surfaces.
+    _stack = None
+    _parts = ()
+    _parts_signature = None
+
     def __init__(self, stack=[], n0=1):
         self.n0 = n0
+        stack = list(stack)
+        if all(isinstance(layer, OpticalStack) for layer in stack):
+            self._parts = [part for layer in stack for part in layer._get_parts()]
+            return
+
         self.stack = []
         for layer in stack:
             if isinstance(layer, OpticalStack):
@@ -35,68 +59,269 @@ class OpticalStack:
 
         self.stack.sort(key=lambda layer: layer.center[2])
 
+    @property
+    def stack(self):
+        '''The layers of the stack, sorted by z.
+
+        For a view, these are rebuilt from its parts, so they should not be
+        modified in place; assigning new layers turns it into an ordinary
+        stack.'''
+        if self._parts or self._stack is None:
+            sig = tuple(base._signature() for base, transforms in self._parts)
+            if self._stack is not None and sig == self._parts_signature:
+                return self._stack
+
+            layers = []
+            for base, transforms in self._parts:
+                for layer in base.stack:
+                    for sign, shift in transforms:
+                        layer = layer.offset(shift) if sign > 0 else layer.flip(end=shift)
+                    layers.append(layer)
+            layers.sort(key=lambda layer: layer.center[2])
+            self._stack = layers
+            self._parts_signature = sig
+
+        return self._stack
+
+    @stack.setter
+    def stack(self, layers):
+        self._stack = layers
+        self._parts = ()
+
+    def _get_parts(self):
+        if self._parts:
+            return self._parts
+        return [(self, ())]
+
+    def _view(self, transform):
+        view = OpticalStack.__new__(OpticalStack)
+        view.n0 = self.n0
+        view._parts = [(self, (transform,))]
+        return view
+
     def offset(self, offset):
-        return OpticalStack([layer.offset(offset) for layer in self.stack], self.n0)
+        '''Return the stack shifted by offset (a z distance or a vector).
 
+        The result is a view which shares the layers of this stack, so this
+        is cheap, and compiling it reuses the compiled form of this stack.'''
+        return self._view((1, ensure_3D(offset)))
 
-    def trace_rays(self, X, N, z_final, λ=DEFAULT_λ):
-        X = np.asarray(X)
-        N = norm(N)
+    def compile(self, λ=DEFAULT_λ):
+        '''Return the compiled (flattened, immutable) form of the stack at
+        wavelength(s) λ.
 
-        # Quick and dirty way to promote axes -- should probably do something
-        # cleaner if performance is an issue!
+        The result is cached, and rebuilt automatically if the layers of the
+        stack change.'''
+        key = np.asarray(λ, dtype='d')
+        key = (key.shape, key.tobytes())
 
-        X = X * np.ones(N.shape)
-        N = N * np.ones(X.shape)
+        # A view is up to date if the compiled forms of its parts are
+        parts = None
+        if self._parts:
+            parts = [(base.compile(λ), transforms) for base, transforms in self._parts]
+            sig = (self.n0,) + tuple(c for c, t in parts)
+        else:
+            sig = self._signature()
 
-        trace = [X]
+        with _CACHE_LOCK:
+            cache = getattr(self, '_compiled', None)
+            if cache is None:
+                cache = self._compiled = {}
+            entry = cache.get(key)
 
-        n = self.n0
+        if entry is None or entry[0] != sig:
+            with instrument.section('compile'):
+                if parts is None:
+                    compiled = CompiledStack(self, λ)
+                else:
+                    compiled = CompiledStack.combine(parts, self.n0, λ)
+            entry = (sig, compiled)
 
-        for layer in self.stack:
-            if layer.center[2] > z_final:
-                break
+            with _CACHE_LOCK:
+                cache.pop(key, None)
+                if len(cache) >= 16:
+                    cache.pop(next(iter(cache)))
+                cache[key] = entry
+
+        return entry[1]
+
+    def _signature(self):
+        return (self.n0,) + tuple(layer._signature() for layer in self.stack)
+
+    def trace_rays(self, X, N, z_final, λ=DEFAULT_λ, jit=False, out=None, workspace=None, dtype='d',
+            meridional=None, opl=None):
+        '''Trace rays through the stack, returning the points where they hit
+        every layer, with shape λ.shape + rays + (points, 3).
+
+        If out is specified, the trace is written to it instead of a new
+        array.  With a workspace (a vector.Workspace), all the intermediate
+        arrays are reused as well, so that repeated calls with the same
+        number of rays do not allocate memory (this does not apply to the
+        jit version).
+
+        dtype sets the precision of the trace.  Single precision
+        (dtype='f', or np.float32) uses half the memory and is faster for
+        large bundles.  The positions agree with double precision to a few
+        parts in 1E6 of the largest coordinates (~5E-5 mm at 30 mm from the
+        object), and the directions to ~1E-7; see benchmarks/precision.py.
+        This is fine for spot diagrams, but use double precision for
+        optimization near focus.
+
+        If all the rays are meridional (in the x-z plane), and all the layers
+        are centered in this plane, the rays are traced as 2D (x, z) vectors,
+        which is faster and gives identical results.  This is detected
+        automatically (meridional=None), or may be forced on or off.  The
+        jit and workspace versions always trace in 3D.
 
-            z = layer.center[2]
-            Xt, N, n = layer.trace_rays(trace[-1], N, n, λ)
-            trace += Xt
+        If opl is specified (an array with shape λ.shape + rays), the
+        optical path length of each ray, from its start to its final point,
+        is added to it (so it should usually be zeroed first); rays which
+        are killed get nan.  Perfect lenses add the path of an ideal lens
+        for collimated light, so that they focus plane waves with no path
+        difference.'''
+        with instrument.section('trace_rays'):
+            return self.compile(λ).trace_rays(X, N, z_final, jit, out, workspace, dtype, meridional, opl)
 
-        X = trace[-1].copy()
-        good = np.where(N[..., 2] > 0)
-        X[good] += (z_final - z) * N[good]/N[good][..., 2:3]
+    def trace_chunks(self, X, N, z_final, λ=DEFAULT_λ, chunksize=65536, points=None, jit=False, dtype='d'):
+        '''Trace rays in chunks, with bounded memory use.
 
-        trace.append(X)
+        The (broadcast) rays are flattened, and traced chunksize at a time.
+        Generates (trace, N) for each chunk, where trace has shape
+        λ.shape + (chunk, points, 3), and N (the final ray directions) has
+        shape λ.shape + (chunk, 3).  points are the indices of the points
+        of the trace to keep (as in the output of trace_rays, e.g. [-1] for
+        the final positions only); by default all of them are kept.  See
+        trace_rays for dtype.'''
+        return self.compile(λ).trace_chunks(X, N, z_final, chunksize, points, jit, dtype)
 
-        return np.moveaxis(trace, 0, -2)
+    def trace_reduce(self, X, N, z_final, reducers, λ=DEFAULT_λ, chunksize=65536, jit=False, dtype='d'):
+        '''Trace rays in chunks, accumulating statistics of the final ray
+        positions without storing the trace.
 
-    def M(self, λ=DEFAULT_λ, z_final=None):
-        n = index.eval(self.n0, λ)
-        M = np.eye(2)
-        z = 0
+        reducers may be a single reducer or a list of them (see
+        obj_correct.reducers); their results are returned in the same form.'''
+        single = not isinstance(reducers, (list, tuple))
+        if single:
+            reducers = [reducers]
 
+        self.compile(λ).trace_reduce(X, N, z_final, reducers, chunksize, jit, dtype)
+        results = [reducer.result() for reducer in reducers]
+        return results[0] if single else results
+
+    def spot(self, X, N, z_final, λ=DEFAULT_λ, chunksize=65536, jit=False, dtype='d'):
+        '''Centroid and RMS radius of the rays at z_final, computed chunk by
+        chunk (see trace_reduce).
+
+        Returns centroid, rms, with shapes λ.shape + (3,) and λ.shape.'''
+        return tuple(self.trace_reduce(X, N, z_final, [reducers.Centroid(), reducers.RMSSpot()],
+            λ, chunksize, jit, dtype))
+
+    def aberrations(self, X, N, edges, z_focus=None, λ=DEFAULT_λ, z_final=None, chunksize=65536,
+            jit=False, dtype='d'):
+        '''Longitudinal and transverse aberration as a function of NA, for
+        rays from an on-axis object point (see reducers.Aberrations).
+
+        z_focus is the reference image plane, by default the paraxial focus.
+        The rays are traced to z_final (by default the last layer), and
+        extended from there, so any z_final after the last layer gives the
+        same result.'''
+        if z_focus is None:
+            z_focus = self.M(λ)[1]
         if z_final is None:
-            zf = self.stack[-1].center[2]
+            z_final = self.get_end()[2]
+        n0 = index.eval(self.n0, λ)
+        return self.trace_reduce(X, N, z_final, reducers.Aberrations(z_focus, edges, n0),
+            λ, chunksize, jit, dtype)
+
+    def opd(self, X, N, point=None, λ=DEFAULT_λ, z_final=None, chunksize=65536, jit=False, dtype='d'):
+        '''RMS and peak to valley optical path difference of the rays, in
+        waves, relative to a spherical wave converging on point (by default
+        the paraxial focus on the axis); see reducers.OPD.
+
+        The rays are traced to z_final (by default the last layer); the
+        result does not depend on it.'''
+        if point is None:
+            z = self.M(λ)[1]
+            point = np.zeros(np.shape(z) + (3,))
+            point[..., 2] = z
+        if z_final is None:
+            z_final = self.get_end()[2]
+        return self.trace_reduce(X, N, z_final, reducers.OPD(point), λ, chunksize, jit, dtype)
+
+    def best_focus(self, X, N, metric='spot', λ=DEFAULT_λ, z=None, point=(0, 0), z_min=None,
+            chunksize=65536, jit=False, dtype='d'):
+        '''Find the image plane with the smallest RMS spot radius
+        (metric='spot') or RMS optical path difference, in waves, relative to
+        a reference point at (x, y) = point in the plane (metric='opd').
+
+        The rays are traced once, to the last layer, and the best plane is
+        found exactly from their moments (see reducers.RMSSpotFocus and
+        reducers.OPDFocus), with no further tracing.  This treats the rays
+        as straight lines from the last layer, so the best plane may be
+        before it, for a virtual image.  If z_min is specified, the best
+        plane is restricted to z >= z_min (e.g. self.get_end()[2], for a
+        real image).
+
+        Returns a dict with the best plane (z), the RMS there (rms), and the
+        number of rays (n), each with the shape of λ.  If z (an array of
+        planes) is specified, the RMS at each of them is included as well
+        (through_focus, with shape λ.shape + z.shape).'''
+        z_end = self.get_end()[2]
+        if z_min is None:
+            z_min = -np.inf
+        if metric == 'spot':
+            reducer = reducers.RMSSpotFocus(z_end, z_min)
+        elif metric == 'opd':
+            reducer = reducers.OPDFocus(z_end, z_min, point)
         else:
-            zf = z_final
+            raise ValueError(f'metric should be "spot" or "opd" (found "{metric}")')
 
-        for layer in self.stack:
-            z1 = layer.center[2]
-            if z1 > zf:
-                break
+        result = self.trace_reduce(X, N, z_end, reducer, λ, chunksize, jit, dtype)
+        if z is not None:
+            result['through_focus'] = reducer.rms(z)
+        return result
 
-            advance_M(M, z1 - z, False)
-            z = z1
-            M1, n = layer.M(n, λ)
+    def M(self, λ=DEFAULT_λ, z_final=None, offset=0):
+        '''Paraxial (ABCD) matrix of the stack, from z = 0 to z_final.
 
-            M = np.matmul(M1, M)
+        If z_final is not specified, it is the paraxial focus.  λ and offset
+        (a shift of the whole stack along z, as for self.offset(offset).M)
+        may be arrays, in which case the output has shape
+        λ.shape + offset.shape + (2, 2), computed with batched matrix
+        products.
 
-        if z_final is None:
-            z_final = z - M[0, 1] / M[1, 1]
+        Returns M, z_final.'''
+        with instrument.section('M'):
+            return self.compile(λ).M(z_final, offset)
+
+    def trace_jacobian(self, X, N, z_final, λ=DEFAULT_λ):
+        '''Trace rays, and compute the derivatives of the final ray positions
+        and directions with respect to the layer parameters (forward mode).
+
+        Parameters are the z positions of the layers, their radii (only
+        spherical surfaces depend on R), and their thicknesses, where the
+        thickness of layer i is the gap in front of it (changing it moves
+        layer i and everything after it).
 
-        return advance_M(M, z_final - z, False), z_final
+        Returns
+        -------
+        X, N : arrays, shape rays + (3,)
+            Final positions (as the last point of trace_rays) and directions.
+        dX, dN : dicts of arrays, shape rays + (layers, 3)
+            Derivatives, with keys "z", "R" and "t".
+        '''
+        return self.compile(λ).trace_jacobian(X, N, z_final)
+
+    def M_jacobian(self, λ=DEFAULT_λ, z_final=None):
+        '''Paraxial matrix and focus (as returned by M), and their derivatives
+        with respect to the layer parameters (see trace_jacobian).
+
+        Returns M, z_final, dM, dz_final; the derivatives are dicts with keys
+        "z", "R" and "t" of arrays with shape (layers, 2, 2) and (layers,).'''
+        return self.compile(λ).M_jacobian(z_final)
 
     def plot_surfaces(self, r_clip=12.5):
-        for layer in stack:
+        for layer in self.stack:
             pass
 
     def flip(self, offset=0, end=None):
@@ -105,8 +330,7 @@ class OpticalStack:
         if end is None:
             end = self.get_end()
 
-        return OpticalStack([layer.flip(end=(offset+end))
-            for layer in self.stack], self.n0)
+        return self._view((-1, offset + end))
 
     def get_end(self):
         if isinstance(self.stack[-1], OpticalStack):
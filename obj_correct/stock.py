@@ -14,44 +14,437 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from .stack import Element
-import os, json
+from .stack import Element, OpticalStack
+from .compiled import StackBatch
+from . import DEFAULT_λ
+from . import catalog
+from . import instrument
+import numpy as np
+import os, json, numbers
+import concurrent.futures
 DATA_DIR = os.path.join(os.path.split(__file__)[0], "data")
 
 class LensLibrary:
-    def __init__(self, fn):
+    def __init__(self, fn, key='stock'):
         # Do lazy loading!
         self.fn = fn
+        self.key = key
 
     def _check_data(self):
-        if not hasattr(self, 'data'):
-            with open(self.fn, 'r') as f:
-                self.data = json.load(f)
+        if not hasattr(self, 'table'):
+            # Use the packed catalog (memory mapped) if it exists
+            table_fn = catalog.table_fn(self.fn)
+            if os.path.exists(table_fn):
+                self.table = catalog.load(table_fn)
+            else:
+                with open(self.fn, 'r') as f:
+                    self.table = catalog.columns(json.load(f), self.key)
+
+            self.fields = set(self.table.dtype.names) - {self.key}
+            self.rows = {k:i for i, k in enumerate(self.table[self.key].tolist())}
+            self.indexes = {}
+
+    @property
+    def data(self):
+        # Dictionary form of the library, as stored in the JSON file
+        if not hasattr(self, '_data'):
+            self._check_data()
+            self._data = catalog.records(self.table, self.key)
+        return self._data
+
+    def _index(self, field):
+        # Indexes are built the first time a field is searched: numeric
+        #  fields get a sorted index (for binary searches), and string fields
+        #  a hash index (value -> rows).
+        if field not in self.indexes:
+            col = self.table[field]
+            if col.dtype.kind == 'U':
+                col = col.tolist()
+                index = {}
+                for i, v in enumerate(col):
+                    index.setdefault(v, []).append(i)
+                self.indexes[field] = {v:np.array(i) for v, i in index.items()}
+            else:
+                order = np.argsort(col, kind='stable')
+                self.indexes[field] = (order, np.asarray(col[order]))
 
-            self.fields = set(self.data[next(iter(self.data))].keys())
+        return self.indexes[field]
+
+    def _match(self, field, v):
+        # Return the (sorted) rows where field == v, or lo <= field <= hi if
+        #  v = (lo, hi)
+        index = self._index(field)
+
+        if isinstance(index, dict):
+            if isinstance(v, tuple):
+                rows = [i for k, i in index.items() if k >= v[0] and k <= v[1]]
+                return np.sort(np.concatenate(rows)) if rows else np.zeros(0, dtype=int)
+            else:
+                return index.get(v, np.zeros(0, dtype=int))
+        else:
+            order, vals = index
+            if isinstance(v, tuple):
+                lo, hi = v
+            else:
+                lo = hi = v
+            if not all(isinstance(x, numbers.Real) for x in (lo, hi)):
+                return np.zeros(0, dtype=int)
+            i0 = np.searchsorted(vals, lo, 'left')
+            i1 = np.searchsorted(vals, hi, 'right')
+            return np.sort(order[i0:i1])
 
     def search(self, **keys):
         self._check_data()
 
-        items = set(self.data.keys())
+        rows = None
 
         for k, v in keys.items():
             if k not in self.fields:
                 raise ValueError(f'unknown field "{k}"\nvalid options: {self.fields}')
-            if isinstance(v, tuple):
-                items = set(filter(lambda kk: self.data[kk][k] >= v[0] and self.data[kk][k] <= v[1], items))
-            else:
-                items = set(filter(lambda kk: self.data[kk][k] == v, items))
+            match = self._match(k, v)
+            rows = match if rows is None else np.intersect1d(rows, match, assume_unique=True)
 
-        return {k:self.data[k] for k in items}
+        keys = self.table[self.key] if rows is None else self.table[self.key][rows]
+        return {k:self.data[k] for k in keys.tolist()}
 
     def __getitem__(self, k):
-        if k not in self.data:
+        self._check_data()
+
+        if k not in self.rows:
             raise ValueError(f'Unknown item {k}; entries correspond to stock number')
 
-        d = self.data[k]
-        return Element(d['glass'], d['t'], d['R1'], r_clip=d['CA']/2)
+        d = self.table[self.rows[k]]
+        return Element(str(d['glass']), float(d['t']), float(d['R1']), r_clip=float(d['CA'])/2)
 
 
 
 edmund_plano_convex = LensLibrary(os.path.join(DATA_DIR, 'edmund_plano_convex.json'))
+
+
+def candidates(library, flip=(False, True), **query):
+    '''List the (stock_id, flipped) candidates for a sweep, in a deterministic
+    order: by orientation, then in library order.  Keyword arguments are
+    passed to library.search.'''
+    ids = list(library.search(**query))
+    return [(stock_id, flipped) for flipped in flip for stock_id in ids]
+
+
+def fit_position(cover, lens, metric, z_range):
+    '''Find the position of a lens (behind the cover) which minimizes
+    metric(OpticalStack([cover, lens.offset(z)])).
+
+    The whole lens (every layer) is kept inside z_range = (min_z, max_z).
+    Returns (z, error); if the lens is longer than z_range, it does not fit
+    anywhere, and the result is (nan, inf).'''
+    from scipy import optimize
+
+    lo, hi = _bounds([lens], z_range)
+    if hi[0] < lo[0]:
+        return np.nan, np.inf
+    bounds = (lo[0], hi[0])
+
+    def err_func(offset):
+        with instrument.section('metric'):
+            return metric(OpticalStack([cover, lens.offset(offset[0])]))
+
+    with instrument.section('fit_position'):
+        res = optimize.minimize(err_func, (0.5*(bounds[0] + bounds[1]),), bounds=(bounds,))
+    return res['x'][0], res['fun']
+
+
+def offset_error(optics, X, N, λ=DEFAULT_λ, z_final=15):
+    '''Transverse (x) offset of rays from the axis, after projecting them back
+    from z_final to the paraxial focus.  Works for an OpticalStack or a
+    StackBatch (in which case the output has a leading batch axis).'''
+    M, z = optics.M() if isinstance(optics, StackBatch) else optics.M(λ)
+    trace = optics.trace_rays(X, N, z_final) if isinstance(optics, StackBatch) \
+        else optics.trace_rays(X, N, z_final, λ)
+
+    # Get the slope of the final ray (killed rays give nan)
+    Nf = trace[..., -1, :] - trace[..., -2, :]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        Nf /= Nf[..., 2:3]
+
+    # Project it back to the focus plane for paraxial rays
+    z = np.reshape(z, np.shape(z) + (1,) * (trace.ndim - 1 - np.ndim(z)))
+    Xt = trace[..., -1, :] + (z - trace[..., -1, 2:3]) * Nf
+
+    return Xt[..., 0]
+
+
+def offset_error_jacobian(optics, X, N, λ=DEFAULT_λ, z_final=15):
+    '''offset_error for an OpticalStack, together with its exact derivatives
+    with respect to the layer parameters (see OpticalStack.trace_jacobian).
+
+    Returns err, derr: err has the shape of the rays, and derr is a dict
+    (keys "z", "R" and "t") of arrays with shape rays + (layers,).  For
+    example, the gradient of the mean square error with respect to the
+    position of the last two layers (e.g. a correction lens) is:
+        (2 * err[:, np.newaxis] * derr['z'][:, -2:].sum(-1)).mean(0)'''
+    M, z, dM, dz = optics.M_jacobian(λ)
+    Xf, Nf, dXf, dNf = optics.trace_jacobian(X, N, z_final, λ)
+
+    s = Nf / Nf[..., 2:3]
+    err = Xf[..., 0] + (z - Xf[..., 2]) * s[..., 0]
+
+    derr = {}
+    for k in dXf:
+        dx, dn = dXf[k], dNf[k]
+        ds = (dn[..., 0] - s[..., 0:1] * dn[..., 2]) / Nf[..., 2:3]
+        dzk = dz[k][:dx.shape[-2]]
+        derr[k] = dx[..., 0] + (dzk - dx[..., 2]) * s[..., 0:1] + (z - Xf[..., 2:3]) * ds
+
+    return err, derr
+
+
+def golden_section(func, lo, hi, xtol=1E-4, maxiter=100):
+    '''Minimize many independent 1D functions at once by golden-section
+    search.
+
+    func(x) takes an array of positions (one per problem) and returns an
+    array of the same shape; each function should be unimodal in
+    [lo, hi].  Because the brackets shrink at the same rate for every
+    problem, they all converge together.  Returns (x, func(x)).'''
+    g = (np.sqrt(5) - 1) / 2
+    a, b = np.broadcast_arrays(np.asarray(lo, dtype='d'), np.asarray(hi, dtype='d'))
+    c = b - g * (b - a)
+    d = a + g * (b - a)
+    fc, fd = func(c), func(d)
+
+    for i in range(maxiter):
+        if (b - a < xtol).all():
+            break
+
+        # If f(c) < f(d), the minimum is in [a, d], otherwise in [c, b]
+        left = fc < fd
+        a = np.where(left, a, c)
+        b = np.where(left, d, b)
+        x = np.where(left, b - g * (b - a), a + g * (b - a))
+        fx = func(x)
+        c, d, fc, fd = (np.where(left, x, d), np.where(left, c, x),
+            np.where(left, fx, fd), np.where(left, fc, fx))
+
+    left = fc < fd
+    return np.where(left, c, d), np.where(left, fc, fd)
+
+
+def _bounds(lenses, z_range):
+    # Allowed offsets of each lens, as for fit_position; hi < lo if a lens
+    #  does not fit in z_range
+    lo = np.empty(len(lenses))
+    hi = np.empty(len(lenses))
+    for i, lens in enumerate(lenses):
+        zl = [layer.center[2] for layer in lens.stack]
+        lo[i] = z_range[0] - min(zl)
+        hi[i] = z_range[1] - max(zl)
+    return lo, hi
+
+
+def fit_positions(cover, lenses, metric, z_range, λ=DEFAULT_λ, xtol=1E-4):
+    '''Batched version of fit_position: find the best position of every lens
+    at once.
+
+    All the candidate stacks (cover + lens) are traced together as a
+    StackBatch, and the positions are found with golden_section, so each
+    iteration is a single traced array.  Here metric(batch) should return
+    one error per stack in the batch (e.g. built from offset_error).
+    Returns arrays (z, error); as for fit_position, lenses which do not fit
+    in z_range get z = nan and error = inf.'''
+    z = np.full(len(lenses), np.nan)
+    err = np.full(len(lenses), np.inf)
+    nc = len(cover.stack)
+
+    # Lenses with different numbers of layers go in different batches
+    lo, hi = _bounds(lenses, z_range)
+    groups = {}
+    for i, lens in enumerate(lenses):
+        if hi[i] >= lo[i]:
+            groups.setdefault(len(lens.stack), []).append(i)
+
+    for group in groups.values():
+        # The batch is compiled with each lens at its lower bound
+        batch = StackBatch([OpticalStack([cover, lenses[i].offset(lo[i])]) for i in group], λ)
+        layers = slice(nc, None)
+
+        def err_func(dz):
+            with instrument.section('metric'):
+                return metric(batch.offset(dz, layers))
+
+        with instrument.section('fit_positions'):
+            dz, e = golden_section(err_func, np.zeros(len(group)), hi[group] - lo[group], xtol)
+        z[group] = lo[group] + dz
+        err[group] = e
+
+    return z, err
+
+
+def _overlaps(v, spec):
+    # For each pair of neighboring samples, could v be within spec between
+    #  them?  (Assumes v is monotonic between samples.)
+    if spec is None:
+        return np.ones(v[..., 1:].shape, dtype=bool)
+    a, b = v[..., :-1], v[..., 1:]
+    return (np.maximum(a, b) >= spec[0]) & (np.minimum(a, b) <= spec[1])
+
+
+def paraxial_prefilter(cover, lenses, z_range, focus=None, magnification=None,
+        samples=21, λ=DEFAULT_λ):
+    '''Use the paraxial (ABCD) matrices to find which lenses could possibly
+    meet a specification at some position behind the cover.
+
+    The matrices of every lens at `samples` evenly spaced positions in its
+    allowed range (see fit_position) are computed together as a single
+    StackBatch, so this is much cheaper than tracing rays.  Between samples
+    the focus and magnification are assumed to be monotonic.
+
+    Parameters
+    ----------
+    cover : OpticalStack
+    lenses : list of OpticalStack
+    z_range : (min_z, max_z)
+    focus : (lo, hi)
+        Allowed range for the paraxial focus (z_final returned by M).
+    magnification : (lo, hi)
+        Allowed range for the paraxial magnification of the z = 0 plane
+        (M[0, 0] at the focus).
+    samples : int
+        Number of positions to sample for each lens (at least 2).
+    λ : float
+
+    Returns
+    -------
+    keep : bool array
+        True for lenses which may meet the specification.
+    '''
+    keep = np.zeros(len(lenses), dtype=bool)
+    nc = len(cover.stack)
+    u = np.linspace(0, 1, samples)
+
+    groups = {}
+    for i, lens in enumerate(lenses):
+        groups.setdefault(len(lens.stack), []).append(i)
+
+    for group in groups.values():
+        lo, hi = _bounds([lenses[i] for i in group], z_range)
+        batch = StackBatch([OpticalStack([cover, lenses[i].offset(lo[j])])
+            for j, i in enumerate(group)], λ)
+
+        # Every (lens, position) pair is one stack in the batch
+        K = len(group)
+        dz = (hi - lo)[:, np.newaxis] * u
+        batch = batch.take(np.repeat(np.arange(K), samples)).offset(dz.ravel(), slice(nc, None))
+
+        with np.errstate(invalid='ignore', divide='ignore'), instrument.section('paraxial_prefilter'):
+            M, zf = batch.M()
+
+        ok = _overlaps(zf.reshape(K, samples), focus) & \
+            _overlaps(M[:, 0, 0].reshape(K, samples), magnification)
+        keep[group] = ok.any(-1) & (hi >= lo)
+
+    return keep
+
+
+def _fit_chunk(cover, metric, z_range, lenses):
+    # Evaluated in the worker processes/threads
+    return [fit_position(cover, lens, metric, z_range) for lens in lenses]
+
+
+def sweep(cover, library, metric, z_range, query={}, flip=(False, True),
+        executor='process', workers=None, chunksize=4, progress=None, paraxial=None):
+    '''Find the best position of every stock lens behind a cover, and rank
+    them by the resulting error.
+
+    Parameters
+    ----------
+    cover : OpticalStack
+        The optics in front of the correction lens.
+    library : LensLibrary
+        The stock lenses to try.
+    metric : function
+        Called as metric(optical_stack) to get the error to minimize.  If a
+        process pool is used, this must be picklable (e.g. a module level
+        function).
+    z_range : (min_z, max_z)
+        Allowed range of positions for the lens; see fit_position.
+    query : dict
+        Passed to library.search to select the lenses.
+    flip : tuple of bool
+        Orientations to try.
+    executor : 'process', 'thread', 'batch', None or concurrent.futures.Executor
+        How to evaluate the candidates; None evaluates them serially, and
+        'batch' fits all of them at once with fit_positions (in which case
+        metric should accept a StackBatch).
+    workers : int
+        Number of workers, if an executor is created.
+    chunksize : int
+        Number of candidates sent to a worker at once.
+    progress : function
+        If specified, called as progress(done, total) as candidates finish.
+    paraxial : dict
+        If specified, candidates are first screened with paraxial_prefilter
+        (this dict gives its keyword arguments, e.g. focus=(lo, hi)), and
+        only the ones which pass are fit.
+
+    Returns
+    -------
+    results : list of dicts
+        One entry per candidate, sorted by error (ties in candidate order),
+        with keys "stock_id", "flipped", "z", "error" and "lens" (the, possibly
+        flipped, lens without offset).  Lenses which are too long for
+        z_range come last, with z = nan and error = inf, along with any
+        whose error is nan.
+    '''
+    cands = candidates(library, flip, **query)
+    lenses = []
+    for stock_id, flipped in cands:
+        lens = library[stock_id]
+        lenses.append(lens.flip() if flipped else lens)
+
+    if paraxial is not None:
+        keep = paraxial_prefilter(cover, lenses, z_range, **paraxial)
+        cands = [c for c, k in zip(cands, keep) if k]
+        lenses = [l for l, k in zip(lenses, keep) if k]
+
+    chunks = [(i, lenses[i:i+chunksize]) for i in range(0, len(lenses), chunksize)]
+    fits = [None] * len(lenses)
+    done = 0
+
+    if executor == 'batch':
+        fits = list(zip(*fit_positions(cover, lenses, metric, z_range)))
+        if progress is not None:
+            progress(len(lenses), len(lenses))
+    elif executor is None:
+        for i, chunk in chunks:
+            fits[i:i+len(chunk)] = _fit_chunk(cover, metric, z_range, chunk)
+            done += len(chunk)
+            if progress is not None:
+                progress(done, len(lenses))
+    else:
+        if executor == 'process':
+            pool = concurrent.futures.ProcessPoolExecutor(workers)
+        elif executor == 'thread':
+            pool = concurrent.futures.ThreadPoolExecutor(workers)
+        else:
+            pool = executor
+
+        try:
+            futures = {pool.submit(_fit_chunk, cover, metric, z_range, chunk): (i, len(chunk))
+                for i, chunk in chunks}
+            for future in concurrent.futures.as_completed(futures):
+                i, n = futures[future]
+                fits[i:i+n] = future.result()
+                done += n
+                if progress is not None:
+                    progress(done, len(lenses))
+        finally:
+            if pool is not executor:
+                pool.shutdown()
+
+    results = [dict(stock_id=stock_id, flipped=flipped, z=z, error=err, lens=lens)
+        for (stock_id, flipped), (z, err), lens in zip(cands, fits, lenses)]
+
+    # Errors may be nan (e.g. if rays are clipped), and those go last too
+    key = lambda i: np.inf if np.isnan(results[i]['error']) else results[i]['error']
+    order = sorted(range(len(results)), key=key)
+
+    return [results[i] for i in order]
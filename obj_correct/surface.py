@@ -15,11 +15,15 @@
 # limitations under the License.
 
 import numpy as np
+import time
 from .vector import *
 from . import DEFAULT_λ
 from . import index
+from . import instrument
 
 class Surface:
+    __slots__ = ('n', 'center', 'r_clip', 'R')
+
     def __init__(self, n, center, r_clip=None, R=None):
         self.n = n
         self.center = ensure_3D(center)
@@ -36,6 +40,10 @@ class Surface:
 
         return s + ')'
 
+    def _signature(self):
+        # Used to detect changes to the layers of a compiled OpticalStack
+        return (type(self), self.n, tuple(self.center), self.r_clip, self.R)
+
     def M(self, n1=1, λ=DEFAULT_λ):
         n2 = index.eval(self.n, λ)
         if self.R is None:
@@ -49,16 +57,76 @@ class Surface:
     def flip(self, end=np.zeros(3)):
         return Surface(self.n, end - self.center, self.r_clip, None if self.R is None else -self.R)
 
-    def trace_rays(self, X, N, n=1, λ=DEFAULT_λ):
-        Xf, Nf, n = self._trace_rays(X, N, n, λ)
+    def trace_rays(self, X, N, n=1, λ=DEFAULT_λ, out=None, workspace=None, opl=None):
+        '''Trace rays through the surface.
+
+        If out = (Xf, Nf) is specified, the outgoing rays are written to these
+        arrays (which may be X and N themselves, to trace in place).
+        Temporary arrays are taken from workspace (a vector.Workspace), if
+        given, so that repeated calls do not allocate memory.
+
+        If opl is specified, the optical path length from X to the outgoing
+        ray position (n times the distance, for normalized N) is added to
+        it; rays which are killed get nan.'''
+        rec = instrument.ACTIVE
+        stats = None
+        if rec is not None:
+            t0, stats, live = time.perf_counter(), {}, np.asarray(N)[..., 2] > 0
+        if opl is not None:
+            X0, N0, n0 = np.array(X), np.array(N), n
+
+        if out is None and workspace is None:
+            Xf, Nf, n = self._trace_rays(X, N, n, λ, stats)
+
+            if self.r_clip is not None:
+                r = mag(Xf[0][..., :2] - self.center[:2])
+                Nf[np.where(r > self.r_clip)] = -1
+        else:
+            ws = Workspace() if workspace is None else workspace
+            shape = np.broadcast_shapes(np.shape(X), np.shape(N))
+            dtype = np.result_type(X, N)
+            Xf, Nf = (ws.get('Xf', shape, dtype), ws.get('Nf', shape, dtype)) if out is None else out
+            np.copyto(Xf, X)
+            np.copyto(Nf, N)
+            Xf, Nf, n = self._trace_rays_inplace(Xf, Nf, n, λ, ws, stats)
 
-        if self.r_clip is not None:
-            r = mag(Xf[0][..., :2] - self.center[:2])
-            Nf[np.where(r > self.r_clip)] = -1
+            if self.r_clip is not None:
+                _clip_inplace(Xf[0], Nf, self.center, self.r_clip, ws)
+
+        if rec is not None:
+            rec.layer((None, self._kind()), time.perf_counter() - t0, live, Nf, **stats)
+
+        if opl is not None:
+            opl += n0 * self._path(X0, N0, Xf[-1], Nf)
+            opl[Nf[..., 2] <= 0] = np.nan
 
         return Xf, Nf, n
 
-    def _trace_rays(self, X, N, n, λ):
+    def _kind(self):
+        # Layer type, as reported by instrument
+        return 'plane' if self.R is None else 'sphere'
+
+    def _path(self, X, N, Xf, Nf):
+        # Path length (divided by the index) from X to Xf
+        return dot(Xf - X, N)
+
+    def _trace_rays(self, X, N, n, λ, stats=None):
+        nf = index.eval(self.n, λ)
+        m = n/nf
+
+        Xf, Nf = _refract(X, N, self.center, self.R, m, stats)
+
+        # Output is ray intersection, normal right, index final
+        return [Xf], Nf, nf
+
+    def _trace_rays_inplace(self, X, N, n, λ, ws, stats=None):
+        nf = index.eval(self.n, λ)
+        _refract_inplace(X, N, self.center, self.R, n/nf, ws, stats)
+        return [X], N, nf
+
+    def _trace_rays_loop(self, X, N, n, λ):
+        # Reference implementation (one ray at a time), kept to validate the
+        #  vectorized version above.  Only accepts (rays, 3) arrays.
         nf = index.eval(self.n, λ)
         m = n/nf
 
@@ -70,9 +138,6 @@ class Surface:
             C = C + (0, 0, self.R)
             sgn = np.sign(self.R)
 
-        # Would it be faster to avoid a loop?  Probably, but with the bad
-        #  ray detection it's a real pain.  Could be accelerated easily with
-        #  numba if required.
         for i, (XX, NN) in enumerate(zip(X, N)):
             if NN[2] <= 0:
                 continue
@@ -82,8 +147,6 @@ class Surface:
                 d = (C[2] - XX[2]) / NN[2]
                 Xf[i] += d * NN
             else:
-                # https://en.wikipedia.org/wiki/Line%E2%80%93sphere_intersection
-                # note: Δ = c - o
                 Δ = C - XX
                 dp = dot(Δ, NN)
                 sqt = dp*dp - (dot(Δ, Δ) - self.R*self.R)
@@ -92,92 +155,20 @@ class Surface:
                     Nf[i] = -1
                     continue
 
-                # sgn > 0: convex surface: first intersection
-                # sgn < 0: concave surface: second intersection
                 Xf[i] += (dp - sgn * np.sqrt(sqt)) * NN
                 Ns = sgn * norm(Xf[i] - C)
 
-            # Compute refraction
-            # http://www.starkeffects.com/snells-law-vector.shtml
             cp = cross(NN, Ns)
             sqt = 1 - m*m * dot(cp, cp)
 
-            # Check for total internal reflection, and kill the ray if we get it!
             if sqt < 0:
                 Nf[i] = -1
                 continue
 
             Nf[i] = norm(m * cross(Ns, cp) - Ns * np.sqrt(sqt))
 
-        # Output is ray intersection, normal right, index final
         return [Xf], Nf, nf
 
-    # OLD VERSION: vectorized with masks, but doesn't work!
-    # def _trace_rays(self, X, N, n, λ):
-    #     nf = index.eval(self.n, λ)
-    #     m = n/nf
-    #     print(n, nf, m)
-    #     Xf = X.copy()
-    #     Nf = N.copy()
-    #
-    #
-    #     # Planar surface
-    #     if self.R is None:
-    #         mask = N[..., 2] > 0
-    #         good = np.where(mask)
-    #
-    #         Ns = np.array([0, 0, -1]) * np.ones(N[good].shape)
-    #
-    #         d = (self.center[2:3] - X[good][..., 2:3]) / N[good][..., 2:3]
-    #         Xf[good] += d * N[good]
-    #
-    #
-    #     # Spherical surface
-    #     else:
-    #         # https://en.wikipedia.org/wiki/Line%E2%80%93sphere_intersection
-    #         # note: Δ = c - o
-    #         C = self.center + (0, 0, self.R)
-    #         Δ = C - Xf
-    #         dp = dot(Δ, N)
-    #         sqt = dp*dp - (dot(Δ, Δ) - self.R*self.R)
-    #
-    #         mask = (sqt >= 0) & (N[..., 2] > 0)
-    #         good = np.where(mask)
-    #
-    #         sgn = np.sign(self.R)
-    #         # sgn > 0: convex surface: first intersection
-    #         # sgn < 0: concave surface: second intersection
-    #         sqt = np.sqrt(sqt[good][..., np.newaxis])
-    #         Xf[good] += (dp[good][..., np.newaxis] - sgn * sqt) * N[good]
-    #         Ns = sgn * norm(Xf[good] - C)
-    #
-    #         # Set "bad" rays
-    #         Nf[np.where(~mask)][..., 2] = -1
-    #
-    #     print(good)
-    #     print(Nf)
-    #     print(Ns)
-    #     # Compute refraction
-    #     # http://www.starkeffects.com/snells-law-vector.shtml
-    #     cp = cross(Nf[good], Ns)
-    #     sqt = 1 - m*m * dot(cp, cp)
-    #
-    #     print(sqt)
-    #
-    #     # Check for total internal reflection, and kill the ray if we get it!
-    #     mask2 = sqt > 0
-    #     Nf[good][np.where(~mask2)][..., 2] = -1
-    #
-    #     good2 = np.where(mask2)
-    #     sqt = np.sqrt(sqt[good][good2][..., np.newaxis])
-    #
-    #     print(mask2)
-    #
-    #     Nf[good][good2] = norm(m * cross(Ns[good2], cp[good2]) - Ns[good2] * sqt)
-    #
-    #     # Output is ray intersection, normal right, index final
-    #     return [Xf], Nf, nf
-
     def edge(self, r_clip=12.5, force_clip=False, curve_points=100):
         if force_clip:
             rc = min(r_clip, self.r_clip)
@@ -199,43 +190,61 @@ class Surface:
 
 
 class PerfectLens(Surface):
-    def __init__(self, f, center, r_clip=None, optical_center=None):
+    # An ideal thin lens, which images every pair of conjugate planes.  The
+    #  optical path through it can only be ideal for one conjugate, though:
+    #  that of an object object_distance in front of the optical center
+    #  (None for an object at infinity).
+    __slots__ = ('f', 'optical_center', 'object_distance')
+
+    def __init__(self, f, center, r_clip=None, optical_center=None, object_distance=None):
         self.center = ensure_3D(center)
         self.f = f
         self.r_clip = r_clip
-        self.optical_center = self.center if optical_center is None else ensure_3D(self.optical_center)
+        self.optical_center = self.center if optical_center is None else ensure_3D(optical_center)
+        self.object_distance = object_distance
 
-    def offset(self, offset):
-        return PerfectLens(self.f, self.center + ensure_3D(offset), self.r_clip, self.optical_center)
+    def __repr__(self):
+        s = f'PerfectLens(f={repr(self.f)}, center={repr(self.center)}'
 
-    def flip(self, end=np.zeros(3)):
-        return PerfectLens(self.f, end - self.center, self.r_clip, end - self.optical_center)
+        if self.r_clip is not None:
+            s += f', r_clip={repr(self.r_clip)}'
+        if self.optical_center is not self.center:
+            s += f', optical_center={repr(self.optical_center)}'
+        if self.object_distance is not None:
+            s += f', object_distance={repr(self.object_distance)}'
 
-    def _trace_rays(self, X, N, n=1, λ=DEFAULT_λ):
-        # Would it be faster to avoid a loop?  Probably, but with the bad
-        #  ray detection it's a real pain.  Could be accelerated easily with
-        #  numba if required.
-        Xi = X.copy()
-        Xf = X.copy()
-        Nf = N / N[:, 2:3]
+        return s + ')'
 
-        for i, (XX, NN) in enumerate(zip(X, N)):
-            if NN[2] <= 0:
-                continue
+    def _signature(self):
+        return (type(self), self.f, tuple(self.center), self.r_clip, tuple(self.optical_center),
+            self.object_distance)
 
-            # Project to surface
-            Xi[i] += (self.center[2] - XX[2]) * Nf[i]
+    def offset(self, offset):
+        offset = ensure_3D(offset)
+        return PerfectLens(self.f, self.center + offset, self.r_clip, self.optical_center + offset,
+            self.object_distance)
+
+    def flip(self, end=np.zeros(3)):
+        return PerfectLens(self.f, end - self.center, self.r_clip, end - self.optical_center,
+            self.object_distance)
+
+    def _vergence(self):
+        # Inverse object distance, as used by _perfect_lens_path
+        return 0 if self.object_distance is None else 1 / self.object_distance
 
-            # Project to virtual lens center
-            Xf[i] += (self.optical_center[2] - XX[2]) * Nf[i]
+    def _kind(self):
+        return 'perfect'
 
-            # Focus
-            Nf[i, :2] -= (Xf[i, :2] - self.optical_center[:2]) / self.f
+    def _path(self, X, N, Xf, Nf):
+        return _perfect_lens_path(X, N, Xf, Nf, self.optical_center, self.f, self._vergence())
 
-            # Propigate to clip plane
-            Xf[i] += (self.center[2] - Xf[i, 2]) * Nf[i]
+    def _trace_rays(self, X, N, n=1, λ=DEFAULT_λ, stats=None):
+        Xi, Xf, Nf = _perfect_lens(X, N, self.center, self.optical_center, self.f)
+        return [Xi, Xf], Nf, n
 
-        return [Xi, Xf], norm(Nf), n
+    def _trace_rays_inplace(self, X, N, n, λ, ws, stats=None):
+        Xi, Xf, Nf = _perfect_lens_inplace(X, N, self.center, self.optical_center, self.f, ws)
+        return [Xi, Xf], Nf, n
 
     def M(self, n0=1, λ=DEFAULT_λ):
         d = self.optical_center[2] - self.center[2]
@@ -243,7 +252,391 @@ class PerfectLens(Surface):
 
 
 def advance_M(M, d, copy=True):
+    # Works on stacks of matrices (..., 2, 2), if d broadcasts against them
     if copy:
         M = np.array(M)
-    M[0] += d * M[1]
+    M[..., 0, :] += np.asarray(d)[..., np.newaxis] * M[..., 1, :]
     return M
+
+
+def _constants(dtype, *args):
+    # Convert layer constants to the precision of the rays, so that (for
+    #  example) float32 rays are not promoted to float64
+    return [None if a is None else np.asarray(a, dtype=dtype) for a in args]
+
+
+def _refract(X, N, center, R, m, stats=None):
+    # Intersect rays with a planar (R = None) or spherical surface and refract
+    #  them; works on any number of leading ray dimensions.  Rays with
+    #  N[2] <= 0 are "bad" and pass through untouched.
+    #
+    # R may also be an array which broadcasts against the rays (with a
+    #  trailing axis, like m), in which case R = 0 marks planar surfaces.
+    #  This is used to trace batches of different stacks at once.
+    #
+    # The vectors may also be 2D (x, z), for meridional rays of surfaces
+    #  centered in the x-z plane; the operations are then exactly those of
+    #  the 3D version with y = 0, so the results are identical.
+    #
+    # If stats is a dict, the number of rays killed by missing the surface
+    #  and by total internal reflection are stored in it (see instrument).
+    center, R, m = _constants(np.result_type(X, N), center, R, m)
+    C = center
+    live = N[..., -1:] > 0
+
+    # Unit vector along z
+    ez = np.zeros(X.shape[-1], dtype=N.dtype)
+    ez[-1] = 1
+
+    # Everything is computed on the full ray array and then selected with
+    #  masks; the bad rays produce nan/inf in the intermediate steps, but
+    #  these are never written to the output.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if R is None:
+            Ns = -ez
+            hit = live
+            Xi = X + ((C[..., -1:] - X[..., -1:]) / N[..., -1:]) * N
+        else:
+            # https://en.wikipedia.org/wiki/Line%E2%80%93sphere_intersection
+            # note: Δ = c - o
+            C = C + R * ez
+            sgn = np.sign(R)
+            Δ = C - X
+            dp = dot1(Δ, N)
+            sqt = dp*dp - (dot1(Δ, Δ) - R*R)
+            hit = live & (sqt >= 0)
+
+            # sgn > 0: convex surface: first intersection
+            # sgn < 0: concave surface: second intersection
+            Xi = X + (dp - sgn * np.sqrt(sqt)) * N
+            Ns = sgn * norm(Xi - C)
+
+            if np.ndim(R):
+                planar = R == 0
+                Xp = X + ((center[..., -1:] - X[..., -1:]) / N[..., -1:]) * N
+                Xi = np.where(planar, Xp, Xi)
+                Ns = np.where(planar, -ez, Ns)
+                hit = np.where(planar, live, hit)
+
+        # Compute refraction
+        # http://www.starkeffects.com/snells-law-vector.shtml
+        if X.shape[-1] == 2:
+            # Only the y component of the cross product is nonzero
+            cp = N[..., 1:2] * Ns[..., 0:1] - N[..., 0:1] * Ns[..., 1:2]
+            sqt = 1 - m*m * (cp*cp)
+            NsXcp = np.concatenate(np.broadcast_arrays(-(Ns[..., 1:2] * cp), Ns[..., 0:1] * cp), -1)
+        else:
+            cp = cross(N, Ns)
+            sqt = 1 - m*m * dot1(cp, cp)
+            NsXcp = cross(Ns, cp)
+
+        # Check for total internal reflection, and kill the ray if we get it!
+        ok = hit & (sqt >= 0)
+        Nr = norm(m * NsXcp - Ns * np.sqrt(sqt))
+
+    Xf = np.where(hit, Xi, X)
+    Nf = np.where(ok, Nr, np.where(live, -1.0, N))
+
+    if stats is not None:
+        _kill_stats(stats, live, hit, ok, Nf)
+
+    return Xf, Nf
+
+
+def _kill_stats(stats, live, hit, ok, N):
+    # Count the rays killed by a surface; the masks may be smaller than the
+    #  rays (if they are broadcast over multiple wavelengths)
+    shape = N.shape[:-1] + (1,)
+    stats['miss'] = int(np.broadcast_to(live & ~hit, shape).sum())
+    stats['tir'] = int(np.broadcast_to(hit & ~ok, shape).sum())
+
+
+def _perfect_lens(X, N, center, optical_center, f):
+    # Returns the position on the lens plane, the position after refocusing
+    #  (also on the lens plane) and the new direction.  As for _refract, bad
+    #  rays are passed through untouched, and the vectors may be 2D (x, z).
+    center, optical_center, f = _constants(np.result_type(X, N), center, optical_center, f)
+    live = N[..., -1:] > 0
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        Ns = N / N[..., -1:]
+
+        # Project to surface
+        Xi = X + (center[-1] - X[..., -1:]) * Ns
+
+        # Project to virtual lens center
+        Xo = X + (optical_center[-1] - X[..., -1:]) * Ns
+
+        # Focus
+        Δ = (Xo - optical_center) / f
+        Δ[..., -1] = 0
+        Ns = Ns - Δ
+
+        # Propigate to clip plane
+        Xf = Xo + (center[-1] - Xo[..., -1:]) * Ns
+
+        Nf = norm(Ns)
+
+    return np.where(live, Xi, X), np.where(live, Xf, X), np.where(live, Nf, N)
+
+
+def _perfect_lens_path(X, N, Xf, Nf, optical_center, f, a=0):
+    # Path length (divided by the index) of rays through a perfect lens, from
+    #  X (with direction N) to Xf (with direction Nf), as returned by
+    #  _perfect_lens.  The lens images every plane, but its phase can only
+    #  make the path from object to image the same for every ray at one
+    #  conjugate: that of an object at distance 1/a in front of the optical
+    #  center (a = 0 for collimated light).  For each ray, the phase is the
+    #  path from the object point to the image point through the optical
+    #  center, less that through the ray's own point on the lens.  Vectors
+    #  may be 2D (x, z), as for _perfect_lens.
+    optical_center, f, a = _constants(np.result_type(X, N), optical_center, f, a)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Path to the optical center plane
+        t = (optical_center[-1] - X[..., -1]) / N[..., -1]
+        Xo = X + t[..., np.newaxis] * N
+
+        s = N[..., :-1] / N[..., -1:]
+        h = Xo[..., :-1] - optical_center[:-1]
+        φ = _conjugate_path(h, s - h/f, 1/f - a) - _conjugate_path(h, s, -a)
+
+        return t + φ + dot(Xf - Xo, Nf)
+
+
+def _conjugate_path(h, s, w):
+    # The path from the optical center to the point at distance d = 1/w
+    #  along the ray through h with slopes s, less that from h (both signed
+    #  by d); written so that it is exact for w = 0 (d infinite).
+    return (dot(h, h)*w + 2*dot(h, s)) / (np.sqrt(dot(h*w + s, h*w + s) + 1) + np.sqrt(1 + dot(s, s)))
+
+
+def _refract_inplace(X, N, center, R, m, ws, stats=None):
+    # In-place version of _refract (for a scalar R or None): X and N are
+    #  overwritten with the outgoing rays, and all temporaries come from the
+    #  Workspace ws.  The operations are done in the same order, so the
+    #  results are identical.
+    center, R, m = _constants(X.dtype, center, R, m)
+    s1 = N.shape[:-1] + (1,)
+    live = np.greater(N[..., 2:3], 0, out=ws.get('live', s1, bool))
+    hit = ws.get('hit', s1, bool)
+    t = ws.get('t', s1, X.dtype)
+    w = ws.get('w', s1, X.dtype)
+    Xi = ws.get('Xi', X.shape, X.dtype)
+    Ns = ws.get('Ns', X.shape, X.dtype)
+    cp = ws.get('cp', X.shape, X.dtype)
+    Nr = ws.get('Nr', X.shape, X.dtype)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if R is None:
+            Ns[...] = (0, 0, -1)
+            np.copyto(hit, live)
+            np.subtract(center[2], X[..., 2:3], out=t)
+            np.divide(t, N[..., 2:3], out=t)
+        else:
+            C = center + R * np.array([0, 0, 1], dtype=X.dtype)
+            sgn = np.sign(R)
+            Δ = np.subtract(C, X, out=Ns)
+            dp = dot1(Δ, N, w, ws)
+            sqt = dot1(Δ, Δ, t, ws)
+            np.subtract(sqt, R*R, out=sqt)
+            np.subtract(np.multiply(dp, dp, out=ws.get('dp2', s1, X.dtype)), sqt, out=sqt)
+            np.greater_equal(sqt, 0, out=hit)
+            np.logical_and(live, hit, out=hit)
+
+            np.sqrt(sqt, out=t)
+            np.multiply(t, -sgn, out=t)
+            np.add(dp, t, out=t)
+
+        np.multiply(t, N, out=Xi)
+        np.add(X, Xi, out=Xi)
+
+        if R is not None:
+            np.subtract(Xi, C, out=Ns)
+            norm(Ns, Ns, ws)
+            np.multiply(Ns, sgn, out=Ns)
+
+        # Refraction, as in _refract
+        cross(N, Ns, cp, ws)
+        sqt = dot1(cp, cp, t, ws)
+        np.multiply(sqt, m*m, out=sqt)
+        np.subtract(1, sqt, out=sqt)
+        ok = np.greater_equal(sqt, 0, out=ws.get('ok', s1, bool))
+        np.logical_and(hit, ok, out=ok)
+
+        cross(Ns, cp, Nr, ws)
+        np.multiply(Nr, m, out=Nr)
+        np.sqrt(sqt, out=sqt)
+        np.subtract(Nr, np.multiply(Ns, sqt, out=cp), out=Nr)
+        norm(Nr, Nr, ws)
+
+    np.copyto(X, Xi, where=hit)
+    np.copyto(N, -1.0, where=live)
+    np.copyto(N, Nr, where=ok)
+
+    if stats is not None:
+        _kill_stats(stats, live, hit, ok, N)
+
+    return X, N
+
+
+def _perfect_lens_inplace(X, N, center, optical_center, f, ws):
+    # In-place version of _perfect_lens: X and N are overwritten with the
+    #  outgoing rays, and the position on the lens plane is returned in a
+    #  workspace array.
+    center, optical_center, f = _constants(X.dtype, center, optical_center, f)
+    s1 = N.shape[:-1] + (1,)
+    live = np.greater(N[..., 2:3], 0, out=ws.get('live', s1, bool))
+    dead = np.logical_not(live, out=ws.get('dead', s1, bool))
+    t = ws.get('t', s1, X.dtype)
+    Ns = ws.get('Ns', X.shape, X.dtype)
+    Xi = ws.get('Xc', X.shape, X.dtype)
+    Xo = ws.get('Xo', X.shape, X.dtype)
+    Δ = ws.get('Δ', X.shape, X.dtype)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        np.divide(N, N[..., 2:3], out=Ns)
+
+        # Project to surface
+        np.subtract(center[2], X[..., 2:3], out=t)
+        np.add(X, np.multiply(t, Ns, out=Xi), out=Xi)
+
+        # Project to virtual lens center
+        np.subtract(optical_center[2], X[..., 2:3], out=t)
+        np.add(X, np.multiply(t, Ns, out=Xo), out=Xo)
+
+        # Focus
+        np.subtract(Xo, optical_center, out=Δ)
+        np.divide(Δ, f, out=Δ)
+        Δ[..., 2] = 0
+        np.subtract(Ns, Δ, out=Ns)
+
+        # Propigate to clip plane
+        np.subtract(center[2], Xo[..., 2:3], out=t)
+        Xf = np.add(Xo, np.multiply(t, Ns, out=Δ), out=Δ)
+
+        norm(Ns, Ns, ws)
+
+    np.copyto(Xi, X, where=dead)
+    np.copyto(X, Xf, where=live)
+    np.copyto(N, Ns, where=live)
+
+    return Xi, X, N
+
+
+def _clip_inplace(Xc, N, center, r_clip, ws):
+    # Kill rays which hit a layer (at Xc) outside of its clip radius
+    shape = N.shape[:-1]
+    Δ = np.subtract(Xc[..., :2], center[:2], out=ws.get('Δxy', shape + (2,), Xc.dtype))
+    clip = np.greater(mag(Δ, ws.get('r', shape, Xc.dtype), ws), r_clip, out=ws.get('clip', shape, bool))
+    np.copyto(N, -1.0, where=clip[..., np.newaxis])
+
+
+def _refract_jac(X, N, dX, dN, center, R, m, dc, dR):
+    # Forward-mode derivatives of _refract (for a single wavelength and a
+    #  scalar R or None).  dX and dN are the derivatives of the incoming rays
+    #  with respect to P parameters, with shape (..., P, 3), and dc (P, 3) and
+    #  dR (P, 1) are the derivatives of the surface center and radius.
+    #  Returns the new rays and their derivatives.
+    live = N[..., 2:3] > 0
+    x = X[..., np.newaxis, :]
+    n = N[..., np.newaxis, :]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if R is None:
+            Ns = np.array([0, 0, -1])
+            dNs = np.zeros(3)
+            hit = live
+            t = (center[2] - X[..., 2:3]) / N[..., 2:3]
+            dt = ((dc[..., 2:3] - dX[..., 2:3]) - t[..., np.newaxis, :] * dN[..., 2:3]) / n[..., 2:3]
+        else:
+            C = center + R * np.array([0, 0, 1], dtype=X.dtype)
+            dC = dc + dR * np.array([0, 0, 1])
+            sgn = np.sign(R)
+            Δ = C - X
+            dΔ = dC - dX
+            dp = dot1(Δ, N)
+            ddp = dot1(dΔ, n) + dot1(Δ[..., np.newaxis, :], dN)
+            sqt = dp*dp - (dot1(Δ, Δ) - R*R)
+            dsqt = 2*dp[..., np.newaxis, :]*ddp - 2*dot1(Δ[..., np.newaxis, :], dΔ) + 2*R*dR
+            hit = live & (sqt >= 0)
+            sqt = np.sqrt(sqt)
+            t = dp - sgn * sqt
+            dt = ddp - sgn * dsqt / (2*sqt[..., np.newaxis, :])
+
+        Xi = X + t * N
+        dXi = dX + dt * n + t[..., np.newaxis, :] * dN
+
+        if R is not None:
+            V = Xi - C
+            l = mag1(V)
+            u = V / l
+            Ns = sgn * u
+            dV = dXi - dC
+            u = u[..., np.newaxis, :]
+            dNs = sgn * (dV - u * dot1(u, dV)) / l[..., np.newaxis, :]
+
+        cp = cross(N, Ns)
+        dcp = cross(dN, Ns[..., np.newaxis, :] if np.ndim(Ns) > 1 else Ns) + cross(n, dNs)
+        sqt = 1 - m*m * dot1(cp, cp)
+        dsqt = -2*m*m * dot1(cp[..., np.newaxis, :], dcp)
+        ok = hit & (sqt >= 0)
+        sqt = np.sqrt(sqt)
+
+        Ns1 = Ns[..., np.newaxis, :] if np.ndim(Ns) > 1 else Ns
+        V = m * cross(Ns, cp) - Ns * sqt
+        dV = (m * (cross(dNs, cp[..., np.newaxis, :]) + cross(Ns1, dcp))
+            - dNs * sqt[..., np.newaxis, :] - Ns1 * dsqt / (2*sqt[..., np.newaxis, :]))
+        l = mag1(V)
+        Nr = V / l
+        u = Nr[..., np.newaxis, :]
+        dNr = (dV - u * dot1(u, dV)) / l[..., np.newaxis, :]
+
+    hit1 = hit[..., np.newaxis, :]
+    ok1 = ok[..., np.newaxis, :]
+    Xf = np.where(hit, Xi, X)
+    Nf = np.where(ok, Nr, np.where(live, -1.0, N))
+    dXf = np.where(hit1, dXi, dX)
+    dNf = np.where(ok1, dNr, np.where(live[..., np.newaxis, :], 0.0, dN))
+
+    return Xf, Nf, dXf, dNf
+
+
+def _perfect_lens_jac(X, N, dX, dN, center, optical_center, f, dc):
+    # Forward-mode derivatives of _perfect_lens; dc (P, 3) is the derivative
+    #  of the lens position (the optical center moves with the lens).
+    live = N[..., 2:3] > 0
+    n = N[..., np.newaxis, :]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        Ns = N / N[..., 2:3]
+        dNs = dN / n[..., 2:3] - n * dN[..., 2:3] / n[..., 2:3]**2
+
+        d = (center[2] - X[..., 2:3])[..., np.newaxis, :]
+        Xi = X + (center[2] - X[..., 2:3]) * Ns
+        dXi = dX + (dc[..., 2:3] - dX[..., 2:3]) * Ns[..., np.newaxis, :] + d * dNs
+
+        d = (optical_center[2] - X[..., 2:3])[..., np.newaxis, :]
+        Xo = X + (optical_center[2] - X[..., 2:3]) * Ns
+        dXo = dX + (dc[..., 2:3] - dX[..., 2:3]) * Ns[..., np.newaxis, :] + d * dNs
+
+        Δ = (Xo - optical_center) / f
+        Δ[..., 2] = 0
+        dΔ = (dXo - dc) / f
+        dΔ[..., 2] = 0
+        Ns = Ns - Δ
+        dNs = dNs - dΔ
+
+        d = (center[2] - Xo[..., 2:3])[..., np.newaxis, :]
+        Xf = Xo + (center[2] - Xo[..., 2:3]) * Ns
+        dXf = dXo + (dc[..., 2:3] - dXo[..., 2:3]) * Ns[..., np.newaxis, :] + d * dNs
+
+        l = mag1(Ns)
+        Nf = Ns / l
+        u = Nf[..., np.newaxis, :]
+        dNf = (dNs - u * dot1(u, dNs)) / l[..., np.newaxis, :]
+
+    live1 = live[..., np.newaxis, :]
+    return (np.where(live, Xi, X), np.where(live1, dXi, dX),
+        np.where(live, Xf, X), np.where(live, Nf, N),
+        np.where(live1, dXf, dX), np.where(live1, dNf, dN))
@@ -17,29 +17,90 @@
 import numpy as np
 π = np.pi
 
-def mag(X):
+def mag(X, out=None, ws=None):
     '''Calculate the length of an array of vectors.'''
-    return np.sqrt((np.asarray(X)**2).sum(-1))
+    if out is None:
+        return np.sqrt((np.asarray(X)**2).sum(-1))
+    dot(X, X, out, ws)
+    return np.sqrt(out, out=out)
 
-def mag1(X):
+def mag1(X, out=None, ws=None):
     '''Calculate the length of an array of vectors, keeping the last dimension
     index.'''
-    return np.sqrt((np.asarray(X)**2).sum(-1))[..., np.newaxis]
+    if out is None:
+        return np.sqrt((np.asarray(X)**2).sum(-1))[..., np.newaxis]
+    mag(X, out[..., 0], ws)
+    return out
 
-def dot(X, Y):
+def dot(X, Y, out=None, ws=None):
     '''Calculate the dot product of two arrays of vectors.'''
-    return (np.asarray(X)*Y).sum(-1)
+    if out is None:
+        return (np.asarray(X)*Y).sum(-1)
 
-def dot1(X, Y):
+    # Summed in the same order as above, so the results are identical
+    X, Y = np.asarray(X), np.asarray(Y)
+    work = scratch(ws, 'dot', out.shape, out.dtype)
+    np.multiply(X[..., 0], Y[..., 0], out=out)
+    for i in range(1, max(X.shape[-1], Y.shape[-1])):
+        np.multiply(X[..., i], Y[..., i], out=work)
+        np.add(out, work, out=out)
+    return out
+
+def dot1(X, Y, out=None, ws=None):
     '''Calculate the dot product of two arrays of vectors, keeping the last
     dimension index'''
-    return (np.asarray(X)*Y).sum(-1)[..., np.newaxis]
+    if out is None:
+        return (np.asarray(X)*Y).sum(-1)[..., np.newaxis]
+    dot(X, Y, out[..., 0], ws)
+    return out
 
-def norm(X):
+def norm(X, out=None, ws=None):
     '''Computes a normalized version of an array of vectors.'''
-    return X / mag1(X)
+    if out is None:
+        return X / mag1(X)
+    l = mag1(X, scratch(ws, 'norm', out.shape[:-1] + (1,), out.dtype), ws)
+    return np.divide(X, l, out=out)
+
+def cross(X, Y, out=None, ws=None):
+    '''Calculate the cross product of two arrays of vectors.'''
+    if out is None:
+        return np.cross(X, Y)
+
+    # out may not be the same array as X or Y!
+    X, Y = np.asarray(X), np.asarray(Y)
+    work = scratch(ws, 'cross', out.shape[:-1], out.dtype)
+    for i in range(3):
+        j, k = (i+1) % 3, (i+2) % 3
+        np.multiply(X[..., j], Y[..., k], out=out[..., i])
+        np.multiply(X[..., k], Y[..., j], out=work)
+        np.subtract(out[..., i], work, out=out[..., i])
+    return out
+
+
+class Workspace:
+    '''Scratch arrays, reused between calls.
+
+    The vector functions above (and the ray tracing which uses them) accept
+    an optional output array `out`, and a Workspace `ws` for their
+    temporaries; repeated calls with the same shapes then do not allocate
+    any new arrays.'''
+    def __init__(self):
+        self.arrays = {}
+
+    def get(self, name, shape, dtype='d'):
+        '''Return the scratch array with the given name, shape and dtype
+        (its contents are undefined).'''
+        key = (name, tuple(shape), np.dtype(dtype).str)
+        a = self.arrays.get(key)
+        if a is None:
+            a = self.arrays[key] = np.empty(shape, dtype)
+        return a
 
-cross = np.cross
+def scratch(ws, name, shape, dtype='d'):
+    '''Get a scratch array from a Workspace, or a new one if ws is None.'''
+    if ws is None:
+        return np.empty(shape, dtype)
+    return ws.get(name, shape, dtype)
 
 def ensure_3D(x):
     if isinstance(x, (int, float)):
@@ -13,6 +13,9 @@ setup(
         # 'numpy',
         # 'PyQt5',
     ],
+    extras_require={
+        'jit': ['numba'], # Optional: compiled ray tracing (see obj_correct/jit.py)
+    },
     # scripts=['bin/muvi_convert'],
     # entry_points={
     #     'gui_scripts': ['muvi=muvi.view.qtview:qt_viewer']
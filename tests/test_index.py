@@ -0,0 +1,37 @@
+#!/usr/bin/python3
+#
+# Copyright 2022 Dustin Kleckner
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import concurrent.futures
+from obj_correct import index
+
+
+def test_lru_cache_threads():
+    # A small cache shared between threads, so that entries are evicted
+    #  while others are being read
+    cache = index.LRUCache(maxsize=8)
+
+    def work(i):
+        return [cache.get(k % 13, lambda: k % 13 * 2) == k % 13 * 2 for k in range(i, i + 2000)]
+
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        assert all(all(ok) for ok in pool.map(work, range(16)))
+
+    info = cache.info()
+    assert info['hits'] + info['misses'] == 16 * 2000
+    assert info['size'] == 8
+
+    cache.clear()
+    assert cache.info()['size'] == 0
@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+#
+# Copyright 2022 Dustin Kleckner
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+from obj_correct import stack, stock, surface, reducers, jit
+from obj_correct.vector import norm, Workspace
+
+
+def biconvex():
+    return stack.OpticalStack([stack.Element('N-BK7', 3, R1=10, R2=-10).offset(30)])
+
+
+def fan(NA=0.3, count=21):
+    g = np.linspace(-NA, NA, count)
+    N = np.stack(np.broadcast_arrays(*np.meshgrid(g, g), 1.), -1).reshape(-1, 3)
+    return np.zeros(3), norm(N)
+
+
+class Final:
+    uses_opl = False
+
+    def __init__(self):
+        self.X = []
+
+    def update(self, X, N, **info):
+        self.X.append(X[N[..., 2] > 0])
+
+    def result(self):
+        return np.concatenate(self.X)
+
+
+@pytest.mark.parametrize('use_jit', [False, True] if jit.HAS_NUMBA else [False])
+def test_final_plane(use_jit):
+    optics = biconvex()
+    X, N = fan()
+    for z_final in (60, 80):
+        Xf = optics.trace_reduce(X, N, z_final, Final(), chunksize=100, jit=use_jit)
+        assert len(Xf) and (Xf[..., 2] == z_final).all()
+        c, rms = optics.spot(X, N, z_final, jit=use_jit)
+        assert c[2] == z_final
+        assert np.isclose(rms, np.sqrt((Xf[:, :2].var(0)).sum()))
+        assert np.isclose(rms, optics.best_focus(X, N, z=z_final)['through_focus'])
+
+
+def test_best_focus_matches_spot():
+    optics = biconvex()
+    X, N = fan()
+    focus = optics.best_focus(X, N)
+    z = np.linspace(focus['z'] - 1, focus['z'] + 1, 41)
+    rms = np.array([optics.spot(X, N, zi)[1] for zi in z])
+    assert rms.min() >= focus['rms'] * (1 - 1E-9)
+    assert abs(z[rms.argmin()] - focus['z']) <= z[1] - z[0]
+
+
+
+
+def test_moments_merge():
+    rng = np.random.default_rng(0)
+    V = rng.normal(5, 2, (2, 1000, 3))
+    good = rng.uniform(size=(2, 1000)) > 0.2
+    good[1, :400] = False
+
+    whole = reducers._Moments()
+    whole.update(V, good)
+    chunked = reducers._Moments()
+    for i in range(0, 1000, 300):
+        chunked.update(V[:, i:i+300], good[:, i:i+300])
+
+    for k in range(2):
+        v = V[k][good[k]]
+        D = v - v.mean(0)
+        for m in (whole, chunked):
+            assert m.n[k] == len(v)
+            assert np.allclose(m.mean[k], v.mean(0), rtol=1E-13)
+            assert np.allclose(m.C[k], D.T @ D, rtol=1E-12)
+
+@pytest.mark.parametrize('metric', ['spot', 'opd'])
+def test_best_focus_virtual(metric):
+    # As in examples/stock_correct.py: the image is virtual, before the lens
+    optics = stack.OpticalStack([stack.Element('N-BK7', 2).offset(1),
+        stock.edmund_plano_convex['88-675'].flip().offset(3.7)])
+    X, N = fan(0.2)
+    z_paraxial = optics.M()[1]
+    assert z_paraxial < 0
+
+    focus = optics.best_focus(X, N, metric)
+    assert abs(focus['z'] - z_paraxial) < 1E-3
+    assert focus['rms'] < (1E-4 if metric == 'spot' else 1E-2)
+
+    z_end = optics.get_end()[2]
+    focus = optics.best_focus(X, N, metric, z_min=z_end)
+    assert focus['z'] == z_end
+
+JIT = [False, True] if jit.HAS_NUMBA else [False]
+
+
+def perfect_lens(object_distance=None):
+    return stack.OpticalStack([surface.PerfectLens(10, (0, 0, 10), optical_center=(0, 0, 10.5),
+        object_distance=object_distance)])
+
+
+@pytest.mark.parametrize('use_jit', JIT)
+@pytest.mark.parametrize('NA', [0.2, 0.4])
+def test_opd_perfect_lens_collimated(use_jit, NA):
+    optics = perfect_lens()
+    g = np.linspace(-3, 3, 15)
+    X = np.stack(np.broadcast_arrays(*np.meshgrid(g, g), 0.), -1).reshape(-1, 3)
+    for s in (0, NA):
+        N = norm(np.array([s, -s/2, 1]))
+        # Start on a wavefront (a plane normal to the rays)
+        X0 = X - (X @ N)[:, np.newaxis] * N
+        focus = (10*s, -5*s, 20.5)
+        result = optics.opd(X0, N, focus, z_final=25, jit=use_jit)
+        assert result['n'] == len(X) and result['pv'] < 1E-9
+
+
+@pytest.mark.parametrize('use_jit', JIT)
+@pytest.mark.parametrize('NA', [0.2, 0.4])
+def test_opd_perfect_lens_conjugate(use_jit, NA):
+    N = fan(NA, 15)[1]
+
+    # A point at the front focal plane is collimated, so the path to a plane
+    #  normal to the rays is the same for all of them
+    optics = perfect_lens(10)
+    for p in ((0, 0, 0.5), (1, 0.5, 0.5)):
+        opl = np.zeros(len(N))
+        trace = optics.trace_rays(np.broadcast_to(p, N.shape), N, 20, jit=use_jit, opl=opl)
+        Nf = norm(trace[:, -1] - trace[:, -2])
+        assert np.allclose(Nf, Nf[0], rtol=0, atol=1E-12)
+        wavefront = opl - trace[:, -1] @ Nf[0]
+        assert np.ptp(wavefront) < 1E-12
+
+    # Object 15 in front of the lens, image 30 behind (magnification -2)
+    optics = perfect_lens(15)
+    result = optics.opd((0.5, 0, -4.5), N, (-1, 0, 40.5), z_final=50, jit=use_jit)
+    assert result['n'] == len(N) and result['pv'] < 1E-9
+
+
+def test_opl_perfect_lens_paths():
+    optics = perfect_lens(15)
+    X, N = (0.5, 0, -4.5), fan(0.4, 15)[1]
+    X = np.broadcast_to(X, N.shape)
+    opl = np.zeros(len(N))
+    optics.trace_rays(X, N, 50, opl=opl)
+
+    opl_ws = np.zeros(len(N))
+    optics.trace_rays(X, N, 50, workspace=Workspace(), opl=opl_ws)
+    assert np.allclose(opl_ws, opl, rtol=0, atol=1E-12, equal_nan=True)
+
+    layer = optics.stack[0]
+    opl_surface = np.zeros(len(N))
+    Xf, Nf, n = layer.trace_rays(X, N, opl=opl_surface)
+    opl_surface += (50 - Xf[-1][:, 2]) / Nf[:, 2]
+    assert np.allclose(opl_surface, opl, rtol=0, atol=1E-12, equal_nan=True)
+
+    if jit.HAS_NUMBA:
+        opl_jit = np.zeros(len(N))
+        optics.trace_rays(X, N, 50, jit=True, opl=opl_jit)
+        assert np.allclose(opl_jit, opl, rtol=0, atol=1E-12, equal_nan=True)
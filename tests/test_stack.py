@@ -0,0 +1,61 @@
+#!/usr/bin/python3
+#
+# Copyright 2022 Dustin Kleckner
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+from obj_correct import stack
+
+X, N = np.zeros(3), np.array([[0.1, 0, 1], [0, 0.05, 1]])
+
+
+def build(R):
+    # The same stack as the view below, built directly from Surfaces
+    return stack.OpticalStack(stack.Element('N-BK7', 2).offset(1).stack +
+        stack.Element('N-BK7', 3, R1=R, R2=-20).flip().offset(5).stack)
+
+
+def test_view_follows_changes():
+    lens = stack.Element('N-BK7', 3, R1=20, R2=-20)
+    view = stack.OpticalStack([stack.Element('N-BK7', 2).offset(1), lens.flip().offset(5)])
+    assert np.array_equal(view.trace_rays(X, N, 20), build(20).trace_rays(X, N, 20))
+
+    lens.stack[0].R = 10
+    assert np.array_equal(view.trace_rays(X, N, 20), build(10).trace_rays(X, N, 20))
+
+    # Materializing the layers of the view should not stop it from tracking
+    #  its parts
+    view.get_end()
+    lens.stack[0].R = 40
+    assert np.array_equal(view.trace_rays(X, N, 20), build(40).trace_rays(X, N, 20))
+    assert [layer._signature() for layer in view.stack] == [layer._signature() for layer in build(40).stack]
+
+
+def test_view_assign_layers():
+    view = stack.Element('N-BK7', 2).offset(1)
+    view.stack = stack.Element('N-BK7', 3).offset(2).stack
+    assert view.get_end()[2] == 5
+    assert view.compile().center[:, 2].tolist() == [2, 5]
+
+
+def test_generator_input():
+    surfaces = build(20).stack
+    optics = stack.OpticalStack(layer for layer in surfaces)
+    assert len(optics.stack) == len(surfaces) == 4
+    assert np.array_equal(optics.trace_rays(X, N, 20), build(20).trace_rays(X, N, 20))
+
+    parts = [stack.Element('N-BK7', 2).offset(1), stack.Element('N-BK7', 3, R1=20, R2=-20).flip().offset(5)]
+    view = stack.OpticalStack(part for part in parts)
+    assert len(view.stack) == 4
+    assert np.array_equal(view.trace_rays(X, N, 20), build(20).trace_rays(X, N, 20))
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+#
+# Copyright 2022 Dustin Kleckner
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+from obj_correct import stack, stock
+
+COVER = stack.Element('N-BK7', 2).offset(1)
+Z_RANGE = (3.5, 10)
+
+
+def metric(optics):
+    X, N = np.zeros(3), np.zeros((11, 3))
+    N[:, 0] = np.linspace(-0.3, 0.3, 11)
+    N[:, 2] = 1
+    return (stock.offset_error(optics, X, N)**2).mean(-1)
+
+
+def lenses():
+    # The last one is longer than Z_RANGE
+    return [stack.Element('N-BK7', t, R2=-15) for t in (2, 4, 8)]
+
+
+def test_fit_position_bounds():
+    for lens in lenses():
+        z, err = stock.fit_position(COVER, lens, metric, Z_RANGE)
+        t = lens.stack[-1].center[2]
+        if t > Z_RANGE[1] - Z_RANGE[0]:
+            assert np.isnan(z) and err == np.inf
+        else:
+            assert Z_RANGE[0] <= z and z + t <= Z_RANGE[1] and np.isfinite(err)
+
+
+def test_fit_positions_bounds():
+    z, err = stock.fit_positions(COVER, lenses(), metric, Z_RANGE)
+    assert np.isnan(z[-1]) and err[-1] == np.inf
+    for zi, lens in zip(z[:-1], lenses()[:-1]):
+        assert Z_RANGE[0] <= zi and zi + lens.stack[-1].center[2] <= Z_RANGE[1]
+
+    # Same answer as the unbatched fit
+    for zi, lens in zip(z[:-1], lenses()[:-1]):
+        assert abs(zi - stock.fit_position(COVER, lens, metric, Z_RANGE)[0]) < 1E-2
+
+
+def test_prefilter_bounds():
+    keep = stock.paraxial_prefilter(COVER, lenses(), Z_RANGE, focus=(-1E9, 1E9))
+    assert keep.tolist() == [True, True, False]
+
+
+def sweep_metric(optics):
+    # Clipped rays give nan offsets, and so a nan error
+    X, N = np.zeros(3), np.zeros((21, 3))
+    N[:, 0] = np.linspace(-0.4, 0.4, 21)
+    N[:, 2] = 1
+    return (stock.offset_error(optics, X, N)**2).mean(-1)
+
+
+def test_sweep_order_nan():
+    results = stock.sweep(COVER, stock.edmund_plano_convex, sweep_metric, (3.5, 10),
+        query=dict(diameter=(6, 12)), executor='batch')
+    err = np.array([r['error'] for r in results])
+    bad = ~np.isfinite(err)
+
+    assert np.isnan(err).any()
+    # The finite errors come first, in order
+    assert not (bad[:-1] & ~bad[1:]).any()
+    assert (np.diff(err[~bad]) >= 0).all()
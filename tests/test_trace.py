@@ -0,0 +1,128 @@
+#!/usr/bin/python3
+#
+# Copyright 2022 Dustin Kleckner
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Equivalence of the different ray tracing paths: the one ray at a time
+#  reference (Surface._trace_rays_loop), the vectorized NumPy version, the
+#  in place (workspace) version, 2D meridional tracing and the jit version.
+
+import numpy as np
+import pytest
+from obj_correct import stack, stock, surface, jit
+from obj_correct.vector import norm, Workspace
+
+
+def rays(count, NA, meridional=False, seed=0):
+    rng = np.random.default_rng(seed)
+    N = np.ones((count, 3))
+    N[:, :2] = rng.uniform(-NA, NA, (count, 2))
+    if meridional:
+        N[:, 1] = 0
+    return np.zeros((count, 3)), norm(N)
+
+
+SURFACES = [
+    surface.Surface('N-BK7', (0, 0, 2)),
+    surface.Surface('N-BK7', (0.3, -0.2, 2), R=5),
+    surface.Surface('N-BK7', (0, 0, 2), R=-5),
+    # Dense to air, for total internal reflection
+    surface.Surface(1, (0, 0, 2), R=1.5),
+]
+
+STACKS = {
+    'cover and lens': stack.OpticalStack([
+        stack.Element('N-BK7', 2).offset(1),
+        stock.edmund_plano_convex['88-675'].flip().offset(3.7)
+    ]),
+    'unclipped': stack.OpticalStack([
+        stack.OpticalStack([surface.Surface('N-BK7', (0, 0, 1), R=8),
+            surface.Surface(1, (0, 0, 3), R=-8)]),
+        stack.Element('N-SF11', 1.5, R1=-15, r_clip=np.inf).offset(5)
+    ]),
+    'perfect lens': stack.OpticalStack([
+        stack.Element('N-BK7', 2).offset(1),
+        stack.OpticalStack([surface.PerfectLens(8, (0, 0, 6), r_clip=5, optical_center=(0, 0, 6.5))])
+    ]),
+}
+
+
+@pytest.mark.parametrize('s', SURFACES)
+def test_surface_loop(s):
+    X, N = rays(500, 0.8)
+    n = 1.6 if s.n == 1 else 1
+    Xf, Nf, nf = s.trace_rays(X, N, n)
+    Xl, Nl, nl = s._trace_rays_loop(X, N, n, 0.5)
+
+    assert nf == nl
+    good = Nl[:, 2] > 0
+    assert (Nf[:, 2] > 0).tolist() == good.tolist()
+    assert good.any()
+    assert np.allclose(Xf[0][good], Xl[0][good], rtol=0, atol=1E-12)
+    assert np.allclose(Nf[good], Nl[good], rtol=0, atol=1E-12)
+
+
+@pytest.mark.parametrize('s', SURFACES)
+def test_surface_inplace(s):
+    X, N = rays(500, 0.8)
+    Xf, Nf, nf = s.trace_rays(X, N)
+    Xi, Ni = X.copy(), N.copy()
+    s.trace_rays(Xi, Ni, out=(Xi, Ni), workspace=Workspace())
+    assert np.array_equal(Xf[0], Xi) and np.array_equal(Nf, Ni)
+
+
+def test_stack_loop():
+    # Chain the reference version through the layers of a stack
+    optics = STACKS['unclipped']
+    X, N = rays(300, 0.4)
+    trace = optics.trace_rays(X, N, 12)
+
+    n = 1
+    for layer in optics.stack:
+        (X,), N, n = layer._trace_rays_loop(X, N, n, 0.5)
+    good = N[:, 2] > 0
+    X[good] += (12 - optics.stack[-1].center[2]) * N[good] / N[good, 2:3]
+
+    assert good.any()
+    assert np.allclose(trace[good, -1], X[good], rtol=0, atol=1E-12)
+
+
+@pytest.mark.parametrize('name', STACKS)
+@pytest.mark.parametrize('λ', [0.5, np.array([0.45, 0.55, 0.65])])
+def test_stack_inplace(name, λ):
+    optics = STACKS[name]
+    X, N = rays(400, 0.5)
+    trace = optics.trace_rays(X, N, 12, λ)
+    ws = Workspace()
+    for i in range(2):
+        assert np.array_equal(trace, optics.trace_rays(X, N, 12, λ, workspace=ws), equal_nan=True)
+
+
+@pytest.mark.parametrize('name', STACKS)
+def test_stack_meridional(name):
+    optics = STACKS[name]
+    X, N = rays(400, 0.5, meridional=True)
+    assert np.array_equal(optics.trace_rays(X, N, 12, meridional=True),
+        optics.trace_rays(X, N, 12, meridional=False), equal_nan=True)
+
+
+@pytest.mark.skipif(not jit.HAS_NUMBA, reason='numba is not installed')
+@pytest.mark.parametrize('name', STACKS)
+def test_stack_jit(name):
+    optics = STACKS[name]
+    X, N = rays(400, 0.5)
+    λ = np.array([0.45, 0.65])
+    trace = optics.trace_rays(X, N, 12, λ)
+    traced = optics.trace_rays(X, N, 12, λ, jit=True)
+    assert np.allclose(trace, traced, rtol=0, atol=1E-12, equal_nan=True)